@@ -1,5 +1,13 @@
-from .videoio import VideoIO
+from .videoio import VideoIO, I420Frame
 from .analytics import Analytics
+from .events import EventBus
+from .renderer import Renderer
+from .loadcontroller import LoadController
+from .metrics import Metrics, LatencyStats, FrameTrace
 from .objectdetector import ObjectDetector
 from .kalmantracker import KalmanTracker
-from .flow import Flow
\ No newline at end of file
+from .flow import Flow
+from .framecontext import FrameContext
+from .evaluation import MOTEvaluator
+from .trackexport import TrackWriter, TrackReader
+from .pipeline import ProcessPipeline
\ No newline at end of file
@@ -1,10 +1,15 @@
 from enum import Enum
 from pathlib import Path
+from copy import copy
 import json
-import cv2
 
 from .objectdetector import ObjectDetector
 from .kalmantracker import KalmanTracker
+from .scheduler import DetectorScheduler
+from .renderer import Overlay
+from .events import EventBus
+from .framecontext import FrameContext
+from .utils import RegionOfInterest
 from .configs import decoder
 
 
@@ -15,21 +20,37 @@ class Analytics:
     with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
         config = json.load(config_file, cls=decoder.decoder)['Analytics']
 
-    def __init__(self, size, capture_dt, enable_drawing=False):
+    def __init__(self, size, capture_dt, enable_drawing=False, detectors=None):
         self.size = size
         self.enable_drawing = enable_drawing
         self.acq_detector_frame_skip = Analytics.config['acq_detector_frame_skip']
         self.trk_detector_frame_skip = Analytics.config['trk_detector_frame_skip']
         self.acquisition_interval = Analytics.config['acquisition_interval']
+        self.adaptive_detector_schedule = Analytics.config['adaptive_detector_schedule']
+        self.async_detector = Analytics.config['async_detector']
+        self.max_detector_latency = Analytics.config['max_detector_latency']
         self.classes = Analytics.config['classes'] # person, bicycle, car, elephant, zebra
         self.target_classes = Analytics.config['target_classes'] # person, elephant
+        # rect (xmin, ymin, xmax, ymax) or polygon of the processed part of the frame in fractions of its size
+        self.roi = None if Analytics.config['roi'] is None else RegionOfInterest(self.size, Analytics.config['roi'])
 
-        ObjectDetector.init_backend()
-        print('[Analytics] Loading acquisition detector model...')
-        self.acq_detector = ObjectDetector(self.size, self.classes, ObjectDetector.Type.ACQUISITION)
-        print('[Analytics] Loading tracking detector model...')
-        self.trk_detector = ObjectDetector(self.size, self.classes, ObjectDetector.Type.TRACKING)
-        self.tracker = KalmanTracker(self.size, capture_dt)
+        if detectors is None:
+            ObjectDetector.init_backend()
+            print('[Analytics] Loading acquisition detector model...')
+            self.acq_detector = ObjectDetector(self.size, self.classes, ObjectDetector.Type.ACQUISITION, self.roi)
+            print('[Analytics] Loading tracking detector model...')
+            self.trk_detector = ObjectDetector(self.size, self.classes, ObjectDetector.Type.TRACKING, self.roi)
+        else:
+            # detectors running elsewhere, e.g. in the detector process of ProcessPipeline
+            self.acq_detector = detectors[ObjectDetector.Type.ACQUISITION]
+            self.trk_detector = detectors[ObjectDetector.Type.TRACKING]
+            self.async_detector = True
+        self.tracker = KalmanTracker(self.size, capture_dt, self.roi)
+        self.events = EventBus.get()
+        self.scheduler = DetectorScheduler(self.size) if self.adaptive_detector_schedule else None
+        # alternate two contexts so the tracker can keep the previous one while buffers are reused
+        flow = self.tracker.flow
+        self.contexts = [FrameContext(flow.optflow_scaling, flow.bkg_feature_scaling, self.roi) for _ in range(2)]
         
         # reset flags
         self.status = Analytics.Status.SEARCHING
@@ -39,35 +60,51 @@ class Analytics:
         self.acquisition_start_frame = 0
         self.track_id = None
         self.frame_count = 0
+        self.detector_frame_count = 0
+        self.detections = []
+        self.detector_tiles = []
+        # multiplier on the detector frame skip set by load shedding
+        self.detector_skip_scale = 1
     
-    def run(self, frame):
+    def run(self, frame, timestamp=None):
+        ctx = self.contexts[self.frame_count % 2]
+        ctx.reset(frame, timestamp)
         detections = []
+        self.detector_tiles = []
+        follow_id = None if self.acquire else self.track_id
         if self.frame_count == 0:
-            print('\n[Analytics] Acquiring new targets...')
-            detections = self.detector.detect_sync(frame)
-            self.tracker.init(frame, detections)
+            self.events.emit(EventBus.Type.ACQUIRE, self.frame_count)
+            detections = self.detector.detect_sync(ctx)
+            self.tracker.init(ctx, detections)
+            self.detector_frame_count += 1
+        elif self.async_detector:
+            detections = self._run_async(ctx, follow_id)
         else:
-            if self.frame_count % self.detector_frame_skip == 0:
-                self.detector.preprocess(frame, self.tracker.tracks, track_id=self.track_id)
-                self.detector.infer_async()
-                self.tracker.track(frame)
+            if self._should_detect():
+                self.detector_frame_count += 1
+                self.detector.preprocess(ctx, self.tracker.tracks, self.track_id, self.tracker.track_index)
+                self.detector.infer_async(self.frame_count)
+                self.tracker.track(ctx, follow_id=follow_id)
                 detections = self.detector.postprocess()
                 self.tracker.update(detections, self.detector.cur_tile, self.detector.tile_overlap, acquire=self.acquire)
+                self.detector_tiles = [self.detector.cur_tile] if self.detector.cur_tile is not None else self.detector.tiles
             else:
-                self.tracker.track(frame)
+                self.tracker.track(ctx, follow_id=follow_id)
+        self.detections = detections
 
         if self.enable_drawing:
-            self._draw(frame, detections, debug=False)
+            self._draw(ctx.bgr, detections, debug=False)
 
         if self.acquire:
             if self.frame_count - self.acquisition_start_frame + 1 == self.acquisition_interval:
                 self.track_id = self.tracker.get_nearest_track(self.target_classes)
                 if self.track_id is not None:
                     self.acquire = False
+                    self.acq_detector.cancel()
                     self.detector = self.trk_detector
                     self.detector_frame_skip = self.trk_detector_frame_skip
                     self.status = Analytics.Status.TARGET_ACQUIRED
-                    print('[Analytics] Following: %s' % self.tracker.tracks[self.track_id])
+                    self.events.emit(EventBus.Type.FOLLOW, self.frame_count, self.tracker.tracks[self.track_id])
                 else:
                     self.acquisition_start_frame = self.frame_count
                     self.status = Analytics.Status.TARGET_NOT_FOUND
@@ -75,40 +112,91 @@ class Analytics:
                 self.status = Analytics.Status.SEARCHING
         elif self.track_id not in self.tracker.tracks:
             self.acquire = True
+            self.trk_detector.cancel()
             self.detector = self.acq_detector
             self.detector_frame_skip = self.acq_detector_frame_skip
             self.acquisition_start_frame = self.frame_count
             self.status = Analytics.Status.TARGET_LOST
-            print('[Analytics] Acquiring new targets...')
+            self.events.emit(EventBus.Type.UNFOLLOW, self.frame_count, track_id=self.track_id)
+            self.events.emit(EventBus.Type.ACQUIRE, self.frame_count)
         self.frame_count += 1
 
     def reset(self):
+        self.acq_detector.cancel()
+        self.trk_detector.cancel()
         self.acquire = True
         self.status = Analytics.Status.SEARCHING
         self.detector = self.acq_detector
         self.detector_frame_skip = self.acq_detector_frame_skip
         self.acquisition_start_frame = 0
         self.frame_count = 0
+        self.detector_frame_count = 0
+        if self.scheduler is not None:
+            self.scheduler.reset()
+
+    def close(self):
+        """
+        Release the tracker threads, call once when done
+        """
+        self.tracker.close()
+
+    @property
+    def detector_duty_cycle(self):
+        return self.detector_frame_count / self.frame_count if self.frame_count > 0 else 0
 
     def get_target_bbox(self):
         assert self.status == Analytics.Status.TARGET_ACQUIRED
         return self.tracker.tracks[self.track_id].bbox
 
-    def _draw(self, frame, detections, debug=False):
-        for track_id, track in self.tracker.tracks.items():
-            if self.status == Analytics.Status.TARGET_ACQUIRED and track_id == self.track_id:
-                track.draw(frame, follow=True, draw_feature_match=debug)
-                # track.draw(frame, follow=True, draw_feature_match=True)
-            else:
-                track.draw(frame, draw_feature_match=debug)
-                # track.draw(frame, draw_feature_match=True)
-        if debug:
-            [det.draw(frame) for det in detections]
-            # self.tracker.flow.draw_bkg_feature_match(frame)
-            if self.frame_count % self.detector_frame_skip == 0:
-                self.detector.draw_tile(frame)
+    def get_overlay(self, debug=False):
+        """
+        Snapshot the current tracks so that they can be drawn on another thread
+        """
+        follow_id = self.track_id if self.status == Analytics.Status.TARGET_ACQUIRED else None
+        text = None
         if self.acquire:
-            cv2.putText(frame, 'Acquiring', (30, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2, cv2.LINE_AA)
+            text = 'Acquiring'
         elif self.status == Analytics.Status.TARGET_ACQUIRED:
-            cv2.putText(frame, 'Following %d' % self.track_id, (30, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2, cv2.LINE_AA)
-    
\ No newline at end of file
+            text = 'Following %d' % self.track_id
+        # tracks are updated by reassignment so shallow copies are safe to draw
+        tracks = [copy(track) for track in self.tracker.tracks.values()]
+        if debug:
+            return Overlay(tracks, follow_id, text, self.detections, self.detector_tiles, self.roi)
+        return Overlay(tracks, follow_id, text)
+
+    def _run_async(self, ctx, follow_id):
+        """
+        Hand the frame to the detector without waiting for it. Tracking runs on
+        the following frames and results are applied once they are ready, or
+        after max_detector_latency frames at the latest.
+        """
+        detections = []
+        if self._should_detect():
+            if self.detector.num_pending == self.detector.num_buffers:
+                detections.extend(self._collect_detections())
+            self.detector_frame_count += 1
+            self.detector.preprocess(ctx, self.tracker.tracks, self.track_id, self.tracker.track_index)
+            self.detector.infer_async(self.frame_count)
+        self.tracker.track(ctx, follow_id=follow_id)
+        while self.detector.num_pending > 0 and (self.detector.is_ready() or
+                self.frame_count - self.detector.pending[0].frame_idx >= self.max_detector_latency):
+            detections.extend(self._collect_detections())
+        return detections
+
+    def _collect_detections(self):
+        detections = self.detector.postprocess()
+        request = self.detector.last_request
+        # detections of an earlier frame are fused through the tracker history
+        self.tracker.update(detections, request.tile, self.detector.tile_overlap, acquire=self.acquire, frame_idx=request.frame_idx)
+        self.detector_tiles = [request.tile] if request.tile is not None else self.detector.tiles
+        return detections
+
+    def _should_detect(self):
+        if self.scheduler is not None:
+            self.scheduler.skip_scale = self.detector_skip_scale
+            return self.scheduler.should_detect(self.tracker)
+        return self.frame_count % (self.detector_frame_skip * self.detector_skip_scale) == 0
+
+    def _draw(self, frame, detections, debug=False):
+        self.get_overlay(debug).draw(frame, debug)
+        # self.tracker.flow.draw_bkg_feature_match(frame)
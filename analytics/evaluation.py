@@ -0,0 +1,170 @@
+from collections import OrderedDict
+import argparse
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+
+def load_mot(path, min_conf=None, classes=None):
+    """
+    Load a MOT format file (frame, id, x, y, w, h, conf, ...) into an array
+    of shape (N, 7) sorted by frame: frame, id, xmin, ymin, xmax, ymax, conf
+    """
+    data = np.loadtxt(path, delimiter=',', ndmin=2, dtype=np.float64)
+    if data.size == 0:
+        return np.empty((0, 7))
+    keep = np.ones(len(data), dtype=bool)
+    if min_conf is not None:
+        keep &= data[:, 6] >= min_conf
+    if classes is not None and data.shape[1] > 7:
+        keep &= np.isin(data[:, 7], list(classes))
+    data = data[keep]
+    boxes = np.empty((len(data), 7))
+    boxes[:, :2] = data[:, :2]
+    boxes[:, 2:4] = data[:, 2:4]
+    boxes[:, 4:6] = data[:, 2:4] + data[:, 4:6]
+    boxes[:, 6] = data[:, 6]
+    return boxes[np.argsort(boxes[:, 0], kind='stable')]
+
+
+def frame_slices(boxes, frames):
+    """
+    Compute the row range of each frame in an array sorted by frame
+    """
+    begin = np.searchsorted(boxes[:, 0], frames, side='left')
+    end = np.searchsorted(boxes[:, 0], frames, side='right')
+    return begin, end
+
+
+def iou_matrix(boxes1, boxes2):
+    """
+    Vectorized IoU between two sets of (xmin, ymin, xmax, ymax) boxes
+    """
+    inter_wh = np.minimum(boxes1[:, None, 2:4], boxes2[None, :, 2:4]) - np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    inter_area = np.prod(np.clip(inter_wh, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:4] - boxes1[:, :2], axis=1)
+    area2 = np.prod(boxes2[:, 2:4] - boxes2[:, :2], axis=1)
+    union = area1[:, None] + area2[None, :] - inter_area
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(union > 0, inter_area / union, 0)
+
+
+class MOTEvaluator:
+    """
+    CLEAR MOT and identity metrics for a single sequence
+    """
+    def __init__(self, iou_thresh=0.5):
+        self.iou_thresh = iou_thresh
+
+    def evaluate(self, gt, hyp):
+        """
+        Score hypothesis against ground truth, both in the layout returned by load_mot
+        """
+        frames = np.union1d(gt[:, 0], hyp[:, 0])
+        gt_begin, gt_end = frame_slices(gt, frames)
+        hyp_begin, hyp_end = frame_slices(hyp, frames)
+
+        gt_ids, gt_idx = np.unique(gt[:, 1], return_inverse=True)
+        hyp_ids, hyp_idx = np.unique(hyp[:, 1], return_inverse=True)
+        # last matched hypothesis and tracked flag of each ground truth trajectory
+        last_match = np.full(len(gt_ids), -1)
+        was_tracked = np.zeros(len(gt_ids), dtype=bool)
+        # frames each (gt, hyp) pair overlaps for identity matching
+        overlap_count = np.zeros((len(gt_ids), len(hyp_ids)))
+
+        num_matches = num_switches = num_frags = 0
+        total_iou = 0.
+        for i in range(len(frames)):
+            g_rows = slice(gt_begin[i], gt_end[i])
+            h_rows = slice(hyp_begin[i], hyp_end[i])
+            g_idx, h_idx = gt_idx[g_rows], hyp_idx[h_rows]
+            if len(g_idx) == 0:
+                continue
+            if len(h_idx) == 0:
+                was_tracked[g_idx] = False
+                continue
+            iou_mat = iou_matrix(gt[g_rows, 2:6], hyp[h_rows, 2:6])
+            valid = iou_mat >= self.iou_thresh
+            gi, hi = np.nonzero(valid)
+            # count each identity pair at most once per frame
+            pairs = np.unique(np.stack((g_idx[gi], h_idx[hi])), axis=1)
+            overlap_count[pairs[0], pairs[1]] += 1
+
+            matched_g, matched_h = self._match(iou_mat, valid, last_match[g_idx], h_idx)
+            matched = np.zeros(len(g_idx), dtype=bool)
+            matched[matched_g] = True
+            g_match, h_match = g_idx[matched_g], h_idx[matched_h]
+            num_switches += np.count_nonzero((last_match[g_match] >= 0) & (last_match[g_match] != h_match))
+            num_frags += np.count_nonzero(~was_tracked[g_match] & (last_match[g_match] >= 0))
+            last_match[g_match] = h_match
+            was_tracked[g_idx] = matched
+            num_matches += len(matched_g)
+            total_iou += iou_mat[matched_g, matched_h].sum()
+
+        num_gt, num_hyp = len(gt), len(hyp)
+        num_misses = num_gt - num_matches
+        num_false_positives = num_hyp - num_matches
+
+        # global identity assignment maximizing identity true positives
+        idtp = 0
+        if overlap_count.size > 0:
+            row, col = linear_sum_assignment(-overlap_count)
+            idtp = overlap_count[row, col].sum()
+        metrics = OrderedDict()
+        metrics['num_frames'] = len(frames)
+        metrics['num_gt'] = num_gt
+        metrics['num_hyp'] = num_hyp
+        metrics['num_matches'] = num_matches
+        metrics['num_false_positives'] = num_false_positives
+        metrics['num_misses'] = num_misses
+        metrics['num_switches'] = num_switches
+        metrics['num_fragmentations'] = num_frags
+        metrics['mota'] = 1 - (num_misses + num_false_positives + num_switches) / num_gt if num_gt > 0 else np.nan
+        metrics['motp'] = total_iou / num_matches if num_matches > 0 else np.nan
+        metrics['idtp'] = idtp
+        metrics['idf1'] = 2 * idtp / (num_gt + num_hyp) if num_gt + num_hyp > 0 else np.nan
+        return metrics
+
+    def evaluate_files(self, gt_path, hyp_path, gt_min_conf=1, gt_classes=None):
+        """
+        Score a MOT format hypothesis file against a ground truth file
+        """
+        gt = load_mot(gt_path, min_conf=gt_min_conf, classes=gt_classes)
+        hyp = load_mot(hyp_path)
+        return self.evaluate(gt, hyp)
+
+    def _match(self, iou_mat, valid, prev_match, h_idx):
+        # keep correspondences from the previous frame that are still valid
+        keep = (prev_match[:, None] == h_idx[None, :]) & valid
+        kept_g, kept_h = np.nonzero(keep)
+        # a hypothesis can only continue one trajectory, prefer the largest overlap
+        order = np.argsort(-iou_mat[kept_g, kept_h], kind='stable')
+        _, first = np.unique(kept_h[order], return_index=True)
+        kept_g, kept_h = kept_g[order[first]], kept_h[order[first]]
+        free_g = np.setdiff1d(np.arange(len(prev_match)), kept_g)
+        free_h = np.setdiff1d(np.arange(len(h_idx)), kept_h)
+        if len(free_g) == 0 or len(free_h) == 0:
+            return kept_g, kept_h
+        # solve the remaining assignment by maximizing overlap
+        sub_valid = valid[np.ix_(free_g, free_h)]
+        if not sub_valid.any():
+            return kept_g, kept_h
+        cost = np.where(sub_valid, 1 - iou_mat[np.ix_(free_g, free_h)], len(free_g) + 1)
+        row, col = linear_sum_assignment(cost)
+        mask = sub_valid[row, col]
+        return np.concatenate((kept_g, free_g[row[mask]])), np.concatenate((kept_h, free_h[col[mask]]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('gt', help='Path to MOT format ground truth file')
+    parser.add_argument('hyp', help='Path to MOT format tracking log')
+    parser.add_argument('--iou', type=float, default=0.5, help='Minimum IoU for a match')
+    args = parser.parse_args()
+
+    metrics = MOTEvaluator(args.iou).evaluate_files(args.gt, args.hyp)
+    for name, value in metrics.items():
+        print('%s: %s' % (name, round(value, 4) if isinstance(value, float) else value))
+
+
+if __name__ == '__main__':
+    main()
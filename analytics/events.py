@@ -0,0 +1,189 @@
+from enum import Enum
+from pathlib import Path
+from collections import deque, namedtuple
+import threading
+import atexit
+import time
+import json
+
+from .models.ssd import COCO_LABELS
+from .configs import decoder
+
+
+# compact record, formatting is left to the drain thread
+Event = namedtuple('Event', ['time', 'type', 'frame_idx', 'track_id', 'label', 'bbox', 'reason', 'data'])
+
+
+class EventBus:
+    """
+    Track lifecycle and pipeline events. Emitting only appends a record to a
+    bounded ring, a background thread drains it to subscribers and prints the
+    records at or above the configured level. When the ring is full the
+    oldest records are dropped. Printing is rate limited per type with a token
+    bucket, subscribers still receive every record.
+    """
+    class Type(Enum):
+        TRACK_BIRTH = 0
+        TRACK_CONFIRM = 1
+        TRACK_LOST = 2
+        FOLLOW = 3
+        UNFOLLOW = 4
+        ACQUIRE = 5
+        REGISTRATION_FAILED = 6
+        CAMERA_MOTION = 7
+        CAMERA_STATIC = 8
+        STALE_DETECTIONS = 9
+        LOAD_DEGRADE = 10
+        LOAD_RESTORE = 11
+
+    class Reason(Enum):
+        INIT = 0
+        OUTSIDE_FRAME = 1
+        AGE = 2
+        OUTSIDE_ROI = 3
+
+    class Level(Enum):
+        DEBUG = 10
+        INFO = 20
+        WARNING = 30
+
+    LEVELS = {
+        Type.TRACK_BIRTH: Level.DEBUG,
+        Type.TRACK_CONFIRM: Level.DEBUG,
+        Type.TRACK_LOST: Level.DEBUG,
+        Type.FOLLOW: Level.INFO,
+        Type.UNFOLLOW: Level.INFO,
+        Type.ACQUIRE: Level.INFO,
+        Type.REGISTRATION_FAILED: Level.WARNING,
+        Type.CAMERA_MOTION: Level.INFO,
+        Type.CAMERA_STATIC: Level.INFO,
+        Type.STALE_DETECTIONS: Level.WARNING,
+        Type.LOAD_DEGRADE: Level.INFO,
+        Type.LOAD_RESTORE: Level.INFO,
+    }
+
+    with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
+        config = json.load(config_file, cls=decoder.decoder)['EventBus']
+    _instance = None
+
+    @classmethod
+    def get(cls):
+        """
+        Process-wide bus, its drain thread is started on first use
+        """
+        if cls._instance is None:
+            cls._instance = EventBus()
+            cls._instance.start()
+            atexit.register(cls._instance.stop)
+        return cls._instance
+
+    def __init__(self):
+        self.capacity = EventBus.config['capacity']
+        self.drain_interval = EventBus.config['drain_interval']
+        self.log_level = EventBus.Level[EventBus.config['log_level'].upper()]
+        self.log_rate = EventBus.config['log_rate']
+        self.log_burst = EventBus.config['log_burst']
+        assert self.log_rate > 0 and self.log_burst >= 1
+
+        # appends and pops on a deque are atomic, no lock on the emitting side
+        self.ring = deque(maxlen=self.capacity)
+        self.dropped_count = 0
+        self.suppressed_count = 0
+        # per type token buckets as (tokens, time of last update) and records not printed since the last one
+        self.log_buckets = {}
+        self.log_suppressed = {}
+        self.subscribers = []
+        self.exit_event = threading.Event()
+        self.drain_thread = threading.Thread(target=self._drain_events, daemon=True)
+
+    def start(self):
+        if not self.drain_thread.is_alive():
+            self.drain_thread.start()
+
+    def stop(self):
+        """
+        Drain the remaining events and wait for the thread to exit
+        """
+        self.exit_event.set()
+        if self.drain_thread.is_alive():
+            self.drain_thread.join()
+
+    def emit(self, event_type, frame_idx=None, track=None, reason=None, track_id=None, data=None):
+        if len(self.ring) == self.capacity:
+            self.dropped_count += 1
+        if track is None:
+            self.ring.append(Event(time.monotonic(), event_type, frame_idx, track_id, None, None, reason, data))
+        else:
+            self.ring.append(Event(time.monotonic(), event_type, frame_idx, track.track_id, track.label, track.bbox, reason, data))
+
+    def subscribe(self, callback, types=None):
+        """
+        Call callback(event) on the drain thread for events of the given types or all events
+        """
+        types = None if types is None else frozenset(types)
+        self.subscribers = self.subscribers + [(callback, types)]
+
+    def unsubscribe(self, callback):
+        self.subscribers = [(subscriber, types) for subscriber, types in self.subscribers if subscriber is not callback]
+
+    def _drain_events(self):
+        while True:
+            exiting = self.exit_event.wait(self.drain_interval)
+            while self.ring:
+                event = self.ring.popleft()
+                for callback, types in self.subscribers:
+                    if types is None or event.type in types:
+                        callback(event)
+                if EventBus.LEVELS[event.type].value >= self.log_level.value:
+                    self._log(event)
+            if exiting:
+                for event_type in list(self.log_suppressed):
+                    self._log_suppressed(event_type)
+                break
+
+    def _log(self, event):
+        # refill by the emit times so that a late drain does not release a burst
+        tokens, last_time = self.log_buckets.get(event.type, (self.log_burst, event.time))
+        tokens = min(tokens + (event.time - last_time) * self.log_rate, self.log_burst)
+        if tokens < 1:
+            self.log_buckets[event.type] = (tokens, event.time)
+            self.log_suppressed[event.type] = self.log_suppressed.get(event.type, 0) + 1
+            self.suppressed_count += 1
+            return
+        self.log_buckets[event.type] = (tokens - 1, event.time)
+        self._log_suppressed(event.type)
+        print(self.format(event))
+
+    def _log_suppressed(self, event_type):
+        count = self.log_suppressed.pop(event_type, 0)
+        if count > 0:
+            print('[EventBus] Suppressed %d %s events' % (count, event_type.name))
+
+    @staticmethod
+    def format(event):
+        if event.bbox is not None:
+            track = "%s ID%d at %s" % (COCO_LABELS[event.label], event.track_id, event.bbox.cv_rect())
+        if event.type == EventBus.Type.TRACK_BIRTH:
+            return '[Tracker] Track registered: %s' % track
+        if event.type == EventBus.Type.TRACK_CONFIRM:
+            return '[Tracker] Track confirmed: %s' % track
+        if event.type == EventBus.Type.TRACK_LOST:
+            return '[Tracker] Target lost (%s): %s' % (event.reason.name.lower().replace('_', ' '), track)
+        if event.type == EventBus.Type.FOLLOW:
+            return '[Analytics] Following: %s' % track
+        if event.type == EventBus.Type.UNFOLLOW:
+            return '[Analytics] Target lost: ID%d' % event.track_id
+        if event.type == EventBus.Type.ACQUIRE:
+            return '[Analytics] Acquiring new targets...'
+        if event.type == EventBus.Type.REGISTRATION_FAILED:
+            return '[Flow] Background registration failed'
+        if event.type == EventBus.Type.CAMERA_MOTION:
+            return '[Flow] Camera motion detected'
+        if event.type == EventBus.Type.CAMERA_STATIC:
+            return '[Flow] Camera is static'
+        if event.type == EventBus.Type.STALE_DETECTIONS:
+            return '[Tracker] Detections of frame %d are older than the history, fusing as current' % event.frame_idx
+        if event.type == EventBus.Type.LOAD_DEGRADE:
+            return '[LoadController] Degrading to %s (%.1f ms per frame, budget %.1f ms)' % event.data
+        if event.type == EventBus.Type.LOAD_RESTORE:
+            return '[LoadController] Restoring to %s (%.1f ms per frame, budget %.1f ms)' % event.data
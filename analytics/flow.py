@@ -1,11 +1,15 @@
+from enum import Enum
 from pathlib import Path
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
 import numpy as np
 import cv2
 import time
 import copyreg
 
-from .utils import Rect
+from .events import EventBus
+from .utils import Rect, resolution_scale
 from .configs import decoder
 
 
@@ -14,21 +18,47 @@ def _pickle_fast_feature_detector(fast):
 
 
 class Flow:
+    class CameraMotion(Enum):
+        STATIC = 0
+        MOVING = 1
+        AUTO = 2
+
     with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
         config = json.load(config_file, cls=decoder.decoder)['Flow']
     # copyreg.pickle(cv2.FastFeatureDetector, _pickle_fast_feature_detector)
 
-    def __init__(self, size, estimate_camera_motion=False):
+    def __init__(self, size, camera_motion=CameraMotion.MOVING, roi=None):
         self.size = size
-        self.estimate_camera_motion = estimate_camera_motion
-        self.bkg_feature_scaling = Flow.config['bkg_feature_scaling']
-        self.optflow_scaling = Flow.config['optflow_scaling']
-        self.feature_density = Flow.config['feature_density']
+        self.camera_motion = camera_motion
+        self.roi = roi
+        # full homography estimation is toggled at runtime in AUTO mode
+        self.estimate_camera_motion = camera_motion == Flow.CameraMotion.MOVING
+        self.events = EventBus.get()
+        # scalings and pixel parameters are tuned at TUNED_HEIGHT, so that
+        # each stage runs at the same resolution for any frame size
+        self.resolution_scale = resolution_scale(self.size)
+        self.bkg_feature_scaling = tuple(min(scaling / self.resolution_scale, 1) for scaling in Flow.config['bkg_feature_scaling'])
+        self.optflow_scaling = tuple(min(scaling / self.resolution_scale, 1) for scaling in Flow.config['optflow_scaling'])
+        self.feature_density = Flow.config['feature_density'] / self.resolution_scale**2
         self.optflow_err_thresh = Flow.config['optflow_err_thresh']
         self.min_bkg_inlier_count = Flow.config['min_bkg_inlier_count']
         self.feature_dist_factor = Flow.config['feature_dist_factor']
         self.ransac_max_iter = Flow.config['ransac_max_iter']
         self.ransac_conf = Flow.config['ransac_conf']
+        self.num_ransac_threads = Flow.config['num_ransac_threads']
+        self.ransac_reproj_thresh = Flow.config['ransac_reproj_thresh'] * self.resolution_scale
+        self.min_ransac_iter = Flow.config['min_ransac_iter']
+        self.warm_start_inlier_ratio = Flow.config['warm_start_inlier_ratio']
+        self.auto_bkg_feature_count = Flow.config['auto_bkg_feature_count']
+        self.auto_motion_thresh = Flow.config['auto_motion_thresh'] * self.resolution_scale
+        self.auto_static_frames = Flow.config['auto_static_frames']
+        self.max_target_feature_count = Flow.config['max_target_feature_count']
+        self.min_track_feature_count = Flow.config['min_track_feature_count']
+        self.min_capped_feature_ratio = Flow.config['min_capped_feature_ratio']
+        self.max_bkg_feature_count = Flow.config['max_bkg_feature_count']
+        self.bkg_grid = Flow.config['bkg_grid']
+        self.max_flow_time = Flow.config['max_flow_time']
+        self.min_feature_budget_scale = Flow.config['min_feature_budget_scale']
 
         self.gftt_target_feature_params = Flow.config['gftt_target_feature_params']
         self.fast_bkg_feature_thresh = Flow.config['fast_bkg_feature_thresh']
@@ -42,25 +72,63 @@ class Flow:
         # self.optflow_params['criteria'] = (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03)
         
         self.fast_feature_detector = cv2.FastFeatureDetector_create(threshold=self.fast_bkg_feature_thresh)
+        # background features are only detected in the region of interest
+        self.bkg_rect = roi.scaled_rect(self.bkg_feature_scaling) if roi is not None else None
         self.bkg_feature_pts = None
         self.prev_bkg_feature_pts = None
+        self.prev_H_camera = None
+        self.bkg_inlier_ratio = None
+        self.prev_affines = {}
+        self.static_frame_count = 0
+        # fraction of the feature budgets in use, adapted to the flow time ceiling
+        self.feature_budget_scale = 1.0
+        # upper bound on the budget scale set by load shedding
+        self.max_budget_scale = 1.0
+        self.target_feature_count = 0
+        self.ransac_stats = {'warm_start_accepts': 0, 'ransac_runs': 0, 'iters_saved': 0}
+        self.executor = ThreadPoolExecutor(self.num_ransac_threads) if self.num_ransac_threads > 1 else None
 
-    def predict(self, tracks, prev_frame_gray, prev_frame_small, frame_small):
+    def predict(self, tracks, prev_ctx, ctx, follow_id=None, exclude_rects=()):
         """
-        Predict next tracks using optical flow. The function modifies tracks in place.
+        Predict next tracks using optical flow between the previous and current
+        frame contexts. The function modifies tracks in place. Objects in
+        exclude_rects are kept out of the background without being tracked.
         """
+        tic = time.perf_counter()
+        H_camera = self._predict(tracks, prev_ctx, ctx, follow_id, exclude_rects)
+        self._adapt_budget(time.perf_counter() - tic)
+        return H_camera
+
+    def _predict(self, tracks, prev_ctx, ctx, follow_id, exclude_rects):
         # tic = time.perf_counter()
         all_prev_pts = np.empty((0, 2), np.float32)
         target_begin_idices = []
         target_end_idices = []
-        bkg_mask = np.ones(self.size[::-1], dtype=np.uint8) * 255
+        if self.roi is None:
+            bkg_mask = np.full(self.size[::-1], 255, dtype=np.uint8)
+        else:
+            bkg_mask = self.roi.mask.copy()
+        frame_rect = Rect(cv_rect=(0, 0, self.size[0], self.size[1]))
+        for rect in exclude_rects:
+            rect = rect & frame_rect
+            if rect is not None:
+                rect.crop(bkg_mask)[:] = 0
+        track_keypoints = OrderedDict()
+        min_counts = {}
         for track_id, track in list(tracks.items()):
-            inside_bbox = track.bbox & Rect(cv_rect=(0, 0, self.size[0], self.size[1]))
+            inside_bbox = track.bbox & frame_rect
             if track.feature_pts is not None:
                 # only propagate feature points inside the bounding box
-                track.feature_pts = np.array([pt for pt in track.feature_pts if pt in inside_bbox])
-            if track.feature_pts is None or len(track.feature_pts) / inside_bbox.area() < self.feature_density:
-                roi = inside_bbox.crop(prev_frame_gray)
+                pts = track.feature_pts.reshape(-1, 2)
+                track.feature_pts = pts[np.all((pts >= inside_bbox.tl()) & (pts <= inside_bbox.br()), axis=1)]
+            min_counts[track_id] = inside_bbox.area() * self.feature_density
+            # a track capped by the budget is only detected again once it lost most of its share
+            min_count = min_counts[track_id]
+            if track.feature_cap is not None:
+                min_count = min(min_count, track.feature_cap * self.min_capped_feature_ratio)
+            if track.feature_pts is None or len(track.feature_pts) < min_count:
+                track.feature_cap = None
+                roi = inside_bbox.crop(prev_ctx.gray)
                 target_mask = inside_bbox.crop(bkg_mask)
                 target_area = np.count_nonzero(target_mask)
                 est_min_dist = self._estimate_feature_dist(target_area)
@@ -74,37 +142,53 @@ class Flow:
                     keypoints = self._ellipse_filter(keypoints, track.bbox)
             else:
                 keypoints = track.feature_pts
+            track_keypoints[track_id] = keypoints
+            # zero out track in background mask
+            track.bbox.crop(bkg_mask)[:] = 0
+
+        # keep each track's share of the budget, the corners stay in the quality order of their detection
+        allocation = self._allocate_features(tracks, track_keypoints, follow_id)
+        for track_id, keypoints in track_keypoints.items():
+            if allocation[track_id] < len(keypoints):
+                tracks[track_id].feature_cap = allocation[track_id] if allocation[track_id] < min_counts[track_id] else None
             # scale and batch all target keypoints
-            prev_pts = keypoints * self.optflow_scaling
+            prev_pts = keypoints[:allocation[track_id]] * self.optflow_scaling
             target_begin_idices.append(len(all_prev_pts))
             all_prev_pts = np.vstack((all_prev_pts, prev_pts))
             target_end_idices.append(len(all_prev_pts))
-            # zero out track in background mask
-            track.bbox.crop(bkg_mask)[:] = 0
+        self.target_feature_count = len(all_prev_pts)
 
-        if self.estimate_camera_motion:
-            prev_frame_small_bkg = cv2.resize(prev_frame_gray, None, fx=self.bkg_feature_scaling[0], fy=self.bkg_feature_scaling[1])
-            bkg_mask = cv2.resize(bkg_mask, None, fx=self.bkg_feature_scaling[0], fy=self.bkg_feature_scaling[1], interpolation=cv2.INTER_NEAREST)
-            # keypoints = cv2.goodFeaturesToTrack(prev_frame_small_bkg, mask=bkg_mask, **self.gftt_bkg_feature_params)
-            keypoints = self.fast_feature_detector.detect(prev_frame_small_bkg, mask=bkg_mask)
+        # cheap sparse background check for camera motion in AUTO mode
+        check_motion = self.camera_motion == Flow.CameraMotion.AUTO and not self.estimate_camera_motion
+        if self.estimate_camera_motion or check_motion:
+            if self.roi is None:
+                prev_bkg = prev_ctx.bkg
+                bkg_mask = cv2.resize(bkg_mask, None, fx=self.bkg_feature_scaling[0], fy=self.bkg_feature_scaling[1], interpolation=cv2.INTER_NEAREST)
+                bkg_offset = (0, 0)
+            else:
+                prev_bkg = self.bkg_rect.crop(prev_ctx.bkg)
+                bkg_mask = cv2.resize(self.roi.rect.crop(bkg_mask), self.bkg_rect.size, interpolation=cv2.INTER_NEAREST)
+                bkg_offset = self.bkg_rect.tl()
+            # keypoints = cv2.goodFeaturesToTrack(prev_bkg, mask=bkg_mask, **self.gftt_bkg_feature_params)
+            keypoints = self.fast_feature_detector.detect(prev_bkg, mask=bkg_mask)
             if keypoints is not None and len(keypoints) > 0:
-                keypoints = np.float32([kp.pt for kp in keypoints])
-                prev_bkg_pts = keypoints.reshape(-1, 2) / self.bkg_feature_scaling * self.optflow_scaling
+                max_count = self.auto_bkg_feature_count if check_motion else int(self.max_bkg_feature_count * self.feature_budget_scale)
+                keypoints = self._stratify(keypoints, prev_bkg.shape, max_count)
+                prev_bkg_pts = (keypoints.reshape(-1, 2) + bkg_offset) / self.bkg_feature_scaling * self.optflow_scaling
+            elif check_motion:
+                prev_bkg_pts = np.empty((0, 2), np.float32)
             else:
-                tracks.clear()
-                self.bkg_feature_pts = None
-                self.prev_bkg_feature_pts = None
-                print('[Flow] Background registration failed')
-                return None
+                return self._registration_failed(tracks)
             bkg_begin_idx = len(all_prev_pts)
             all_prev_pts = np.vstack((all_prev_pts, prev_bkg_pts))
         # print('feature:', time.perf_counter() - tic)
 
-        # level, pyramid = cv2.buildOpticalFlowPyramid(frame_small, self.optflow_params['winSize'], self.optflow_params['maxLevel'])
-
         # tic = time.perf_counter()
         all_prev_pts = np.float32(all_prev_pts).reshape(-1, 1, 2)
-        all_cur_pts, status, err = cv2.calcOpticalFlowPyrLK(prev_frame_small, frame_small, all_prev_pts, None, **self.optflow_params)
+        if len(all_prev_pts) == 0:
+            # nothing to track, e.g. no targets with a static camera
+            return np.eye(3)
+        all_cur_pts, status, err = cv2.calcOpticalFlowPyrLK(prev_ctx.small, ctx.small, all_prev_pts, None, **self.optflow_params)
         # print(np.max(err[status==1]))
         with np.errstate(invalid='ignore'):
             status_mask = (status == 1) & (err < self.optflow_err_thresh)
@@ -112,7 +196,7 @@ class Flow:
         # print('opt flow:', time.perf_counter() - tic)
 
         # tic = time.perf_counter()
-        H_camera = None
+        H_camera = np.eye(3)
         if self.estimate_camera_motion:
             prev_bkg_pts = all_prev_pts[bkg_begin_idx:][status_mask[bkg_begin_idx:]]
             matched_bkg_pts = all_cur_pts[bkg_begin_idx:][status_mask[bkg_begin_idx:]]
@@ -120,26 +204,33 @@ class Flow:
                 prev_bkg_pts = prev_bkg_pts / self.optflow_scaling
                 matched_bkg_pts = matched_bkg_pts /self.optflow_scaling
                 # H_camera, inlier_mask = cv2.estimateAffinePartial2D(prev_bkg_pts, matched_bkg_pts, method=cv2.RANSAC, maxIters=self.ransac_max_iter, confidence=self.ransac_conf)
-                H_camera, inlier_mask = cv2.findHomography(prev_bkg_pts, matched_bkg_pts, method=cv2.RANSAC, maxIters=self.ransac_max_iter, confidence=self.ransac_conf)
+                H_camera, inlier_mask = self._estimate_camera_motion(prev_bkg_pts, matched_bkg_pts)
                 if H_camera is None or np.count_nonzero(inlier_mask) < self.min_bkg_inlier_count:
-                    tracks.clear()
-                    self.bkg_feature_pts = None
-                    self.prev_bkg_feature_pts = None
-                    print('[Flow] Background registration failed')
-                    return None
+                    return self._registration_failed(tracks)
                 else:
                     # H_camera = np.vstack((H_camera, [0, 0, 1]))
                     inlier_mask = np.bool_(inlier_mask.ravel())
                     self.prev_bkg_feature_pts = prev_bkg_pts[inlier_mask].reshape(-1, 2)
                     self.bkg_feature_pts = matched_bkg_pts[inlier_mask].reshape(-1, 2)
+                    if self.camera_motion == Flow.CameraMotion.AUTO:
+                        self._check_static(H_camera)
             else:
-                tracks.clear()
-                self.bkg_feature_pts = None
-                self.prev_bkg_feature_pts = None
-                print('[Flow] Background registration failed')
-                return None
+                return self._registration_failed(tracks)
+        elif check_motion:
+            prev_bkg_pts = all_prev_pts[bkg_begin_idx:][status_mask[bkg_begin_idx:]] / self.optflow_scaling
+            matched_bkg_pts = all_cur_pts[bkg_begin_idx:][status_mask[bkg_begin_idx:]] / self.optflow_scaling
+            if len(matched_bkg_pts) > 0:
+                dx, dy = np.median(matched_bkg_pts.reshape(-1, 2) - prev_bkg_pts.reshape(-1, 2), axis=0)
+                if np.hypot(dx, dy) > self.auto_motion_thresh:
+                    # approximate this frame with a translation and estimate homographies from the next frame
+                    H_camera = np.array([[1, 0, dx], [0, 1, dy], [0, 0, 1]])
+                    self.estimate_camera_motion = True
+                    self.static_frame_count = 0
+                    self.events.emit(EventBus.Type.CAMERA_MOTION)
 
+        # filter occluded points in order of distance before estimating motion concurrently
         fg_mask = np.ones(self.size[::-1], dtype=np.uint8) * 255
+        track_pts = []
         for begin, end, (track_id, track) in zip(target_begin_idices, target_end_idices, list(tracks.items())):
             prev_pts = all_prev_pts[begin:end][status_mask[begin:end]]
             matched_pts = all_cur_pts[begin:end][status_mask[begin:end]]
@@ -150,7 +241,23 @@ class Flow:
                 del tracks[track_id]
                 # print('[Flow] Target lost (failed to match): %s' % track)
                 continue
-            H_affine, inlier_mask = cv2.estimateAffinePartial2D(prev_pts, matched_pts, method=cv2.RANSAC, maxIters=self.ransac_max_iter, confidence=self.ransac_conf)
+            track_pts.append((track_id, end - begin, prev_pts, matched_pts, *self.prev_affines.get(track_id, (None, None))))
+            # zero out the track shifted by its median flow in foreground mask
+            dx, dy = np.median(matched_pts - prev_pts.reshape(-1, 2), axis=0)
+            occluder = Rect(cv_rect=(int(round(track.bbox.xmin + dx)), int(round(track.bbox.ymin + dy)), *track.bbox.size))
+            occluder = occluder & Rect(cv_rect=(0, 0, self.size[0], self.size[1]))
+            if occluder is not None:
+                occluder.crop(fg_mask)[:] = 0
+
+        if self.executor is not None and len(track_pts) > 1:
+            motions = list(self.executor.map(lambda args: self._estimate_motion(*args[2:]), track_pts))
+        else:
+            motions = [self._estimate_motion(*args[2:]) for args in track_pts]
+
+        prev_affines = {}
+        for (track_id, num_pts, prev_pts, matched_pts, *_), (H_affine, inlier_mask, num_iters) in zip(track_pts, motions):
+            self._update_ransac_stats(num_iters)
+            track = tracks[track_id]
             if H_affine is None:
                 del tracks[track_id]
                 # print('[Flow] Target lost (no inlier): %s' % track)
@@ -167,19 +274,179 @@ class Flow:
             track.feature_pts = matched_pts[inlier_mask].reshape(-1, 2)
             track.prev_feature_pts = prev_pts[inlier_mask].reshape(-1, 2)
             # use inlier ratio as confidence
-            inlier_ratio = len(track.feature_pts) / (end - begin) #len(matched_pts)
+            inlier_ratio = len(track.feature_pts) / num_pts #len(matched_pts)
             track.conf = inlier_ratio
-            # zero out current track in foreground mask
-            track.bbox.crop(fg_mask)[:] = 0
+            prev_affines[track_id] = (H_affine, np.count_nonzero(inlier_mask) / len(inlier_mask))
+        self.prev_affines = prev_affines
         # print('Postprocess:', time.perf_counter() - tic)
         return H_camera
 
+    def close(self):
+        """
+        Stop the RANSAC worker threads
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
     def draw_bkg_feature_match(self, frame):
         if self.bkg_feature_pts is not None:
             [cv2.circle(frame, tuple(pt), 1, (0, 0, 255), -1) for pt in np.int_(np.round(self.bkg_feature_pts))]
         if self.prev_bkg_feature_pts is not None:
             [cv2.line(frame, tuple(pt1), tuple(pt2), (0, 0, 255), 1, cv2.LINE_AA) for pt1, pt2 in zip(np.int_(np.round(self.prev_bkg_feature_pts)), np.int_(np.round(self.bkg_feature_pts)))]
     
+    def _registration_failed(self, tracks):
+        tracks.clear()
+        self.bkg_feature_pts = None
+        self.prev_bkg_feature_pts = None
+        self.prev_H_camera = None
+        self.prev_affines.clear()
+        self.events.emit(EventBus.Type.REGISTRATION_FAILED)
+        return None
+
+    def _allocate_features(self, tracks, track_keypoints, follow_id):
+        """
+        Split the target feature budget across tracks. The followed target is served
+        first, then the rest in distance rank order weighted by box size and flow
+        confidence. Budget left over by a track carries over to the next ones. Every
+        track keeps at least min_track_feature_count points for motion estimation,
+        so with many tracks the total can exceed the budget by up to that many per track.
+        """
+        order = sorted(track_keypoints, key=lambda track_id: track_id != follow_id)
+        weights = np.array([np.sqrt(tracks[track_id].bbox.area()) * tracks[track_id].conf / (rank + 1)
+                            for rank, track_id in enumerate(order)])
+        remaining = int(self.max_target_feature_count * self.feature_budget_scale)
+        allocation = {}
+        for i, track_id in enumerate(order):
+            total_weight = weights[i:].sum()
+            if track_id == follow_id:
+                share = remaining
+            elif total_weight > 0:
+                share = remaining * weights[i] / total_weight
+            else:
+                share = remaining / (len(order) - i)
+            allocation[track_id] = min(len(track_keypoints[track_id]), max(int(share), self.min_track_feature_count))
+            remaining = max(remaining - allocation[track_id], 0)
+        return allocation
+
+    def _stratify(self, keypoints, shape, max_count):
+        """
+        Keep the strongest keypoints in each cell of a grid so that background
+        points are spread over the frame
+        """
+        pts = np.float32([kp.pt for kp in keypoints])
+        if len(pts) <= max_count:
+            return pts
+        response = np.float32([kp.response for kp in keypoints])
+        cols, rows = self.bkg_grid
+        cell_x = np.minimum(np.int_(pts[:, 0] * cols / shape[1]), cols - 1)
+        cell_y = np.minimum(np.int_(pts[:, 1] * rows / shape[0]), rows - 1)
+        cells = cell_y * cols + cell_x
+        order = np.lexsort((-response, cells))
+        sorted_cells = cells[order]
+        # rank of each keypoint by response within its cell
+        rank = np.arange(len(order)) - np.searchsorted(sorted_cells, sorted_cells)
+        keep = order[rank < int(np.ceil(max_count / (cols * rows)))]
+        if len(keep) > max_count:
+            keep = keep[np.argsort(-response[keep], kind='stable')[:max_count]]
+        return pts[keep]
+
+    def _adapt_budget(self, elapsed):
+        # shrink feature budgets quickly when over the time ceiling and recover slowly
+        if elapsed > self.max_flow_time:
+            self.feature_budget_scale = max(self.feature_budget_scale * 0.8, self.min_feature_budget_scale)
+        elif elapsed < 0.8 * self.max_flow_time:
+            self.feature_budget_scale = self.feature_budget_scale * 1.05
+        self.feature_budget_scale = min(self.feature_budget_scale, self.max_budget_scale)
+
+    def _check_static(self, H_camera):
+        # fall back to the sparse check after the camera stays still for a while
+        center = np.array([self.size[0] / 2, self.size[1] / 2, 1])
+        warped = H_camera @ center
+        if np.linalg.norm(warped[:2] / warped[2] - center[:2]) <= self.auto_motion_thresh:
+            self.static_frame_count += 1
+            if self.static_frame_count >= self.auto_static_frames:
+                self.estimate_camera_motion = False
+                self.prev_H_camera = None
+                self.bkg_feature_pts = None
+                self.prev_bkg_feature_pts = None
+                self.events.emit(EventBus.Type.CAMERA_STATIC)
+        else:
+            self.static_frame_count = 0
+
+    def _estimate_camera_motion(self, prev_pts, matched_pts):
+        # try the previous camera motion before running RANSAC
+        H_camera, inlier_mask = self._warm_start(prev_pts, matched_pts, self.prev_H_camera, cv2.perspectiveTransform, self._fit_homography)
+        num_iters = 0
+        if H_camera is None:
+            num_iters = self._ransac_iters(self.bkg_inlier_ratio, 4)
+            H_camera, inlier_mask = cv2.findHomography(prev_pts, matched_pts, method=cv2.RANSAC, ransacReprojThreshold=self.ransac_reproj_thresh, maxIters=num_iters, confidence=self.ransac_conf)
+        self._update_ransac_stats(num_iters)
+        if H_camera is not None:
+            self.prev_H_camera = H_camera
+            self.bkg_inlier_ratio = np.count_nonzero(inlier_mask) / len(inlier_mask)
+        return H_camera, inlier_mask
+
+    def _estimate_motion(self, prev_pts, matched_pts, prev_H_affine=None, prev_inlier_ratio=None):
+        # OpenCV releases the GIL and seeds RANSAC deterministically, so this is safe to run in threads
+        H_affine, inlier_mask = self._warm_start(prev_pts, matched_pts, prev_H_affine, cv2.transform, self._fit_similarity)
+        if H_affine is not None:
+            return H_affine, inlier_mask, 0
+        num_iters = self._ransac_iters(prev_inlier_ratio, 2)
+        H_affine, inlier_mask = cv2.estimateAffinePartial2D(prev_pts, matched_pts, method=cv2.RANSAC, ransacReprojThreshold=self.ransac_reproj_thresh, maxIters=num_iters, confidence=self.ransac_conf)
+        return H_affine, inlier_mask, num_iters
+
+    def _warm_start(self, prev_pts, matched_pts, H, transform, fit):
+        """
+        Accept the previous motion, refined by least squares on its inliers,
+        if it explains enough of the new matches
+        """
+        if H is None:
+            return None, None
+        prev_pts = np.float32(prev_pts).reshape(-1, 1, 2)
+        matched_pts = np.float32(matched_pts).reshape(-1, 2)
+        thresh = self.ransac_reproj_thresh**2
+        inlier_mask = np.sum((transform(prev_pts, H).reshape(-1, 2) - matched_pts)**2, axis=1) <= thresh
+        if np.count_nonzero(inlier_mask) < max(self.warm_start_inlier_ratio * len(inlier_mask), 4):
+            return None, None
+        H = fit(prev_pts[inlier_mask], matched_pts[inlier_mask])
+        if H is None:
+            return None, None
+        inlier_mask = np.sum((transform(prev_pts, H).reshape(-1, 2) - matched_pts)**2, axis=1) <= thresh
+        if np.count_nonzero(inlier_mask) < self.warm_start_inlier_ratio * len(inlier_mask):
+            return None, None
+        return H, np.uint8(inlier_mask).reshape(-1, 1)
+
+    def _fit_homography(self, prev_pts, matched_pts):
+        H, _ = cv2.findHomography(prev_pts, matched_pts, 0)
+        return H
+
+    def _fit_similarity(self, prev_pts, matched_pts):
+        # least squares for x' = a * x - b * y + tx, y' = b * x + a * y + ty
+        prev_pts = prev_pts.reshape(-1, 2).astype(np.float64)
+        matched_pts = matched_pts.reshape(-1, 2).astype(np.float64)
+        A = np.zeros((2 * len(prev_pts), 4))
+        A[0::2] = np.column_stack((prev_pts[:, 0], -prev_pts[:, 1], np.ones(len(prev_pts)), np.zeros(len(prev_pts))))
+        A[1::2] = np.column_stack((prev_pts[:, 1], prev_pts[:, 0], np.zeros(len(prev_pts)), np.ones(len(prev_pts))))
+        (a, b, tx, ty), *_ = np.linalg.lstsq(A, matched_pts.ravel(), rcond=None)
+        return np.array([[a, -b, tx], [b, a, ty]])
+
+    def _ransac_iters(self, inlier_ratio, sample_size):
+        # iterations needed to draw an all-inlier sample with the configured confidence
+        if inlier_ratio is None or inlier_ratio <= 0:
+            return self.ransac_max_iter
+        if inlier_ratio >= 1:
+            return self.min_ransac_iter
+        num_iters = np.log(1 - self.ransac_conf) / np.log(1 - inlier_ratio**sample_size)
+        return int(np.clip(np.ceil(num_iters), self.min_ransac_iter, self.ransac_max_iter))
+
+    def _update_ransac_stats(self, num_iters):
+        if num_iters == 0:
+            self.ransac_stats['warm_start_accepts'] += 1
+        else:
+            self.ransac_stats['ransac_runs'] += 1
+        self.ransac_stats['iters_saved'] += self.ransac_max_iter - num_iters
+
     def _estimate_feature_dist(self, target_area):
         est_ft_dist = round(np.sqrt(target_area) * self.feature_dist_factor)
         return max(est_ft_dist, 1)
@@ -0,0 +1,137 @@
+import numpy as np
+import cv2
+
+from .videoio import I420Frame
+
+
+class FrameContext:
+    """
+    Images derived from a single frame, computed on first use and shared by
+    the tracker, flow and detector. Reusing a context with reset keeps its
+    buffers so that later frames of the same size do not reallocate. Frames
+    are either BGR arrays or I420Frame. With a RegionOfInterest, the background
+    and normalized images are only computed inside its bounding rect, and
+    detector inputs are neutral gray outside the region.
+    """
+    # gray level for pixels outside the region, about zero after normalization
+    NEUTRAL_RGB = 128
+
+    def __init__(self, optflow_scaling, bkg_feature_scaling, roi=None):
+        self.optflow_scaling = optflow_scaling
+        self.bkg_feature_scaling = bkg_feature_scaling
+        self.roi = roi
+        self.frame = None
+        self.timestamp = None
+        self._buffers = {}
+        self._cache = {}
+
+    def reset(self, frame, timestamp=None):
+        """
+        Point the context to a new frame and invalidate derived images
+        """
+        self.frame = frame
+        self.timestamp = timestamp
+        self._cache.clear()
+
+    def compute(self, *names):
+        """
+        Derive images eagerly, e.g. before the frame is drawn on
+        """
+        for name in names:
+            getattr(self, name)
+
+    @property
+    def bgr(self):
+        if isinstance(self.frame, I420Frame):
+            return self.frame.bgr()
+        return self.frame
+
+    @property
+    def gray(self):
+        if isinstance(self.frame, I420Frame):
+            return self.frame.gray
+        if 'gray' not in self._cache:
+            self._cache['gray'] = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY, dst=self._buffer('gray', self.frame.shape[:2], np.uint8))
+        return self._cache['gray']
+
+    @property
+    def small(self):
+        """
+        Gray frame at optical flow scale
+        """
+        if 'small' not in self._cache:
+            self._cache['small'] = self._resize('small', self.optflow_scaling)
+        return self._cache['small']
+
+    @property
+    def bkg(self):
+        """
+        Gray frame at background feature scale
+        """
+        if 'bkg' not in self._cache:
+            self._cache['bkg'] = self._resize('bkg', self.bkg_feature_scaling, self.roi)
+        return self._cache['bkg']
+
+    @property
+    def rgb(self):
+        if 'rgb' not in self._cache:
+            dst = self._buffer('rgb', self.frame.shape, np.uint8)
+            if isinstance(self.frame, I420Frame):
+                self._cache['rgb'] = cv2.cvtColor(self.frame.buf, cv2.COLOR_YUV2RGB_I420, dst=dst)
+            else:
+                self._cache['rgb'] = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB, dst=dst)
+        return self._cache['rgb']
+
+    @property
+    def normalized_rgb(self):
+        """
+        RGB frame normalized to [-1.0, 1.0] as expected by the detector
+        """
+        if 'normalized_rgb' not in self._cache:
+            # only the region is written, the rest keeps its neutral fill
+            normalized = self._buffer('normalized_rgb', self.frame.shape, np.float32, fill_value=0)
+            if self.roi is None:
+                np.multiply(self.rgb, 2 / 255, out=normalized)
+                normalized -= 1
+            else:
+                region = self.roi.rect.crop(normalized)
+                np.multiply(self.crop_rgb(self.roi.rect), 2 / 255, out=region)
+                region -= 1
+            self._cache['normalized_rgb'] = normalized
+        return self._cache['normalized_rgb']
+
+    def crop_rgb(self, rect):
+        """
+        RGB pixels of a tile, converting only the tile unless the full frame is
+        cached. Pixels outside the region of interest are neutral gray.
+        """
+        if 'rgb' in self._cache:
+            tile = rect.crop(self._cache['rgb'])
+            if self.roi is None or self.roi.contains_rect(rect):
+                return tile
+            tile = tile.copy()
+        elif isinstance(self.frame, I420Frame):
+            tile = self.frame.crop_rgb(rect)
+        else:
+            tile = cv2.cvtColor(rect.crop(self.frame), cv2.COLOR_BGR2RGB)
+        if self.roi is not None:
+            self.roi.fill_outside(rect, tile, FrameContext.NEUTRAL_RGB)
+        return tile
+
+    def _resize(self, name, scaling, roi=None):
+        height, width = self.gray.shape
+        dsize = (int(round(width * scaling[0])), int(round(height * scaling[1])))
+        dst = self._buffer(name, dsize[::-1], np.uint8)
+        if roi is None:
+            return cv2.resize(self.gray, dsize, dst=dst)
+        # pixels outside the region are left stale
+        scaled_rect = roi.scaled_rect(scaling)
+        scaled_rect.crop(dst)[:] = cv2.resize(roi.rect.crop(self.gray), scaled_rect.size)
+        return dst
+
+    def _buffer(self, name, shape, dtype, fill_value=None):
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape != tuple(shape):
+            buf = np.empty(shape, dtype) if fill_value is None else np.full(shape, fill_value, dtype)
+            self._buffers[name] = buf
+        return buf
@@ -1,9 +1,8 @@
 from enum import Enum
 from pathlib import Path
 from copy import deepcopy
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import json
-from scipy.optimize import linear_sum_assignment
 from scipy.linalg import solve_triangular
 import numpy as np
 import cv2
@@ -11,22 +10,34 @@ import cv2
 import time
 
 from . import flow
+from .events import EventBus
 from .models.ssd import COCO_LABELS
-from .utils import Rect, iou
+from .utils import Rect, GridIndex, iou, iou_matrix, sparse_linear_assignment, resolution_scale
 from .configs import decoder
 
 
 class Track:
-    def __init__(self, label, bbox, track_id):
+    def __init__(self, label, bbox, track_id, frame_idx=0):
         self.label = label
         self.bbox = bbox
         self.init_bbox = bbox
         self.track_id = track_id
         self.age = 0
+        # tracker frame of the last matched detection
+        self.detection_frame_idx = frame_idx
         self.conf = 1
         self.feature_pts = None
         self.prev_feature_pts = None
+        # feature count the flow budget held the track to, None when not limited
+        self.feature_cap = None
         self.frames_since_acquired = 0
+        # time since the track was registered for the initial velocity
+        self.init_elapsed = 0
+        # state for predicting without flow
+        self.velocity = None
+        self.vel_change = 0
+        self.flow_skip_count = 0
+        self.detector_agrees = True
 
     def __repr__(self):
         return "Track(label=%r, bbox=%r, track_id=%r)" % (self.label, self.bbox, self.track_id)
@@ -50,6 +61,26 @@ class Track:
                     [cv2.line(frame, tuple(pt1), tuple(pt2), (0, 255, 255), 1, cv2.LINE_AA) for pt1, pt2 in zip(np.int_(np.round(self.prev_feature_pts)), np.int_(np.round(self.feature_pts)))]        
 
 
+class FrameStep:
+    """
+    Kalman filter inputs of one tracked frame, kept so that the filters can be
+    rolled back to the start of the frame and the frame replayed
+    """
+    def __init__(self, frame_idx, H_camera, transition_mat, acc_cov):
+        self.frame_idx = frame_idx
+        self.H_camera = H_camera
+        self.warp = H_camera is not None and not np.array_equal(H_camera, np.eye(3))
+        self.transition_mat = transition_mat
+        self.acc_cov = acc_cov
+        # filter states and boxes at the start of the frame, after all updates of the previous frame
+        self.start_states = {}
+        self.start_bboxes = {}
+        # measurements applied during the frame per track: flow as (offset from the
+        # box at the start of the frame, meas_cov), detections as a list of (meas, meas_cov)
+        self.flow_meas = {}
+        self.det_meas = {}
+
+
 class KalmanTracker:
     class Meas(Enum):
         FLOW = 0
@@ -57,13 +88,16 @@ class KalmanTracker:
     # 0.95 quantile of the chi-square distribution with 4 degrees of freedom
     CHI_SQ_INV_95 = 9.4877
     INF_COST = 1e5
+    # number of cached motion models before the cache is reset
+    MAX_MOTION_MODELS = 64
 
     with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
         config = json.load(config_file, cls=decoder.decoder)['KalmanTracker']
 
-    def __init__(self, size, dt):
+    def __init__(self, size, dt, roi=None):
         self.size = size
         self.dt = dt
+        self.roi = roi
         self.acquisition_max_age = KalmanTracker.config['acquisition_max_age']
         self.tracking_max_age = KalmanTracker.config['tracking_max_age']
         self.max_association_maha = KalmanTracker.config['max_association_maha']
@@ -72,32 +106,55 @@ class KalmanTracker:
         self.min_register_conf = KalmanTracker.config['min_register_conf']
         self.num_vertical_bin = KalmanTracker.config['num_vertical_bin']
         self.n_init = KalmanTracker.config['n_init']
-        self.small_size_std_acc = KalmanTracker.config['small_size_std_acc'] # max(w, h)
-        self.large_size_std_acc = KalmanTracker.config['large_size_std_acc']
-        self.min_std_cnn = KalmanTracker.config['min_std_cnn']
-        self.min_std_flow = KalmanTracker.config['min_std_flow']
+        # pixel parameters are tuned at TUNED_HEIGHT
+        scale = resolution_scale(self.size)
+        self.small_size_std_acc = tuple(value * scale for value in KalmanTracker.config['small_size_std_acc']) # max(w, h)
+        self.large_size_std_acc = tuple(value * scale for value in KalmanTracker.config['large_size_std_acc'])
+        self.min_std_cnn = tuple(value * scale for value in KalmanTracker.config['min_std_cnn'])
+        self.min_std_flow = tuple(value * scale for value in KalmanTracker.config['min_std_flow'])
         self.std_factor_cnn = KalmanTracker.config['std_factor_cnn']
         self.std_factor_flow = KalmanTracker.config['std_factor_flow']
         self.init_std_pos_factor = KalmanTracker.config['init_std_pos_factor']
         self.init_std_vel_factor = KalmanTracker.config['init_std_vel_factor']
         self.vel_coupling = KalmanTracker.config['vel_coupling']
         self.vel_half_life = KalmanTracker.config['vel_half_life']
-        self.max_vel = KalmanTracker.config['max_vel']
-        self.min_size = KalmanTracker.config['min_size']
-
-        self.acc_cov = np.diag(np.array([0.25 * self.dt**4] * 4 + [self.dt**2] * 4, dtype=np.float32))
-        self.acc_cov[4:, :4] = np.eye(4, dtype=np.float32) * (0.5 * self.dt**3)
-        self.acc_cov[:4, 4:] = np.eye(4, dtype=np.float32) * (0.5 * self.dt**3)
+        self.max_vel = KalmanTracker.config['max_vel'] * scale
+        self.min_size = KalmanTracker.config['min_size'] * scale
+        self.index_cell_size = tuple(max(int(round(value * scale)), 1) for value in KalmanTracker.config['index_cell_size'])
+        self.camera_motion = flow.Flow.CameraMotion[KalmanTracker.config['camera_motion'].upper()]
+        self.dt_resolution = KalmanTracker.config['dt_resolution']
+        self.max_flow_skip = KalmanTracker.config['max_flow_skip']
+        self.max_skip_pos_std_ratio = KalmanTracker.config['max_skip_pos_std_ratio']
+        self.max_skip_vel_change = KalmanTracker.config['max_skip_vel_change']
+        self.min_skip_flow_conf = KalmanTracker.config['min_skip_flow_conf']
+        self.min_skip_det_iou = KalmanTracker.config['min_skip_det_iou']
+        self.history_size = KalmanTracker.config['history_size']
+        self.min_roi_overlap = KalmanTracker.config['min_roi_overlap']
+
+        # transition and process noise matrices for each distinct frame interval
+        self.motion_models = {}
+        self.frame_dt, self.transition_mat, self.acc_cov = self._get_motion_model(self.dt)
         self.meas_mat = np.eye(4, 8, dtype=np.float32)
         
         self.acquire = True
-        self.prev_frame_gray = None
-        self.prev_frame_small = None
+        self.prev_ctx = None
         # self.prev_pyramid = None
+        self.H_camera = np.eye(3)
+        self.num_flow_skipped = 0
+        # seconds spent in the last call to track and in its flow step
+        self.track_time = 0
+        self.flow_time = 0
+        # frames tracked since init and their steps for delayed detections
+        self.frame_idx = 0
+        self.history = deque(maxlen=self.history_size)
+        # only the nearest tracks get flow when set by load shedding
+        self.max_flow_tracks = None
         self.tracks = OrderedDict()
         self.new_track_id = 0
         self.kalman_filters = {}
-        self.flow = flow.Flow(self.size, estimate_camera_motion=True)
+        self.track_index = GridIndex(self.size, self.index_cell_size)
+        self.events = EventBus.get()
+        self.flow = flow.Flow(self.size, self.camera_motion, self.roi)
         # stage_flow = mpipe.Stage(self.step_flow, 1)
         # stage_kf = mpipe.Stage(self.step_kalman_filter, 1)
         # stage_flow.link(stage_kf)
@@ -174,101 +231,256 @@ class KalmanTracker:
     #     print('kalman filter:', time.perf_counter() - tic)
     #     return 0
 
-    def track(self, frame, use_flow=True):
+    def track(self, ctx, use_flow=True, follow_id=None):
         """
-        Track targets across frames. This function should be called in every frame.
+        Track targets across frames given the FrameContext of the current frame.
+        The motion model follows the time between frame timestamps when available.
+        The followed target gets priority in the flow feature budget, other stable
+        tracks may be predicted by the Kalman filter alone for a few frames.
+        This function should be called in every frame.
         """
-        assert self.prev_frame_gray is not None
-        assert self.prev_frame_small is not None
+        assert self.prev_ctx is not None and self.prev_ctx is not ctx
 
+        track_tic = time.perf_counter()
         # tic = time.perf_counter()
-        frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        frame_small = cv2.resize(frame_gray, None, fx=self.flow.optflow_scaling[0], fy=self.flow.optflow_scaling[1])
+        dt = self.dt
+        if ctx.timestamp is not None and self.prev_ctx.timestamp is not None and ctx.timestamp > self.prev_ctx.timestamp:
+            dt = ctx.timestamp - self.prev_ctx.timestamp
+        self.frame_dt, self.transition_mat, self.acc_cov = self._get_motion_model(dt)
+        self.frame_idx += 1
+        step = FrameStep(self.frame_idx, None, self.transition_mat, self.acc_cov)
+        step.start_states = {track_id: (kalman_filter.statePost.copy(), kalman_filter.errorCovPost.copy())
+                             for track_id, kalman_filter in self.kalman_filters.items()}
+        step.start_bboxes = {track_id: track.bbox for track_id, track in self.tracks.items()}
         self.tracks = OrderedDict(sorted(self.tracks.items(), key=self._compare_dist, reverse=True))
-        flow_tracks = deepcopy(self.tracks)
+        skip_ids = {track_id for rank, track_id in enumerate(self.tracks) if self._should_skip_flow(track_id, follow_id, rank)}
+        flow_tracks = deepcopy(OrderedDict((track_id, track) for track_id, track in self.tracks.items() if track_id not in skip_ids))
+        self.num_flow_skipped = len(skip_ids)
         # print('gray and sort:', time.perf_counter() - tic)
 
-        # tic = time.perf_counter()
-        H_camera = self.flow.predict(flow_tracks, self.prev_frame_gray, self.prev_frame_small, frame_small)
-        self.prev_frame_gray = frame_gray
-        self.prev_frame_small = frame_small
+        flow_tic = time.perf_counter()
+        skip_rects = [self.tracks[track_id].bbox for track_id in skip_ids]
+        H_camera = self.flow.predict(flow_tracks, self.prev_ctx, ctx, follow_id, skip_rects)
+        self.flow_time = time.perf_counter() - flow_tic
+        # the next frame reads these after the current frame may have been drawn on
+        ctx.compute('gray', 'small')
+        self.prev_ctx = ctx
+        self.H_camera = H_camera
+        step.H_camera = H_camera
+        step.warp = H_camera is not None and not np.array_equal(H_camera, np.eye(3))
+        self.history.append(step)
         # self.prev_pyramid = pyramid
         # print('opt flow:', time.perf_counter() - tic)
 
         # tic = time.perf_counter()
         if H_camera is not None:
+            # no warping needed when the camera did not move
+            warp = step.warp
             for track_id, track in list(self.tracks.items()):
                 track.frames_since_acquired += 1
                 if track.frames_since_acquired <= self.n_init:
+                    track.init_elapsed += self.frame_dt
                     if track_id in flow_tracks:
                         flow_track = flow_tracks[track_id]
                         if track.frames_since_acquired == self.n_init:
                             # initialize kalman filter
-                            self.kalman_filters[track_id] = self._create_kalman_filter(track.init_bbox, flow_track.bbox)
+                            self.kalman_filters[track_id] = self._create_kalman_filter(track.init_bbox, flow_track.bbox, track.init_elapsed)
+                            self.events.emit(EventBus.Type.TRACK_CONFIRM, self.frame_idx, track)
                         else:
-                            track.init_bbox = self._warp_bbox(track.init_bbox, H_camera)
+                            if warp:
+                                track.init_bbox = self._warp_bbox(track.init_bbox, H_camera)
                             track.bbox = flow_track.bbox
                             track.feature_pts = flow_track.feature_pts
                             track.prev_feature_pts = flow_track.prev_feature_pts
+                            track.feature_cap = flow_track.feature_cap
                     else:
-                        print('[Tracker] Target lost (init): %s' % track)
+                        self.events.emit(EventBus.Type.TRACK_LOST, self.frame_idx, track, EventBus.Reason.INIT)
                         del self.tracks[track_id]
                 else:
                     # track using kalman filter and flow measurement
-                    self._warp_kalman_filter(track_id, H_camera)
+                    if warp:
+                        self._warp_kalman_filter(track_id, H_camera)
+                    self.kalman_filters[track_id].transitionMatrix = self.transition_mat
+                    self.kalman_filters[track_id].processNoiseCov = self._compute_acc_cov(track.bbox)
                     next_state = self.kalman_filters[track_id].predict()
                     self._clip_state(track_id)
-                    if use_flow and track_id in flow_tracks:
+                    prev_bbox = track.bbox
+                    if track_id in skip_ids:
+                        track.prev_feature_pts = None
+                        track.flow_skip_count += 1
+                    elif use_flow and track_id in flow_tracks:
                         flow_track = flow_tracks[track_id]
-                        self.kalman_filters[track_id].measurementNoiseCov = self._compute_meas_cov(flow_track.bbox, KalmanTracker.Meas.FLOW, flow_track.conf)
+                        meas_cov = self._compute_meas_cov(flow_track.bbox, KalmanTracker.Meas.FLOW, flow_track.conf)
                         flow_meas = self._convert_bbox_to_meas(flow_track.bbox)
+                        # flow moves the box it started from, replays apply the same displacement
+                        step.flow_meas[track_id] = (flow_meas - self._convert_bbox_to_meas(prev_bbox), meas_cov)
+                        self.kalman_filters[track_id].measurementNoiseCov = meas_cov
                         next_state = self.kalman_filters[track_id].correct(flow_meas)
                         self._clip_state(track_id)
                         track.feature_pts = flow_track.feature_pts
                         track.prev_feature_pts = flow_track.prev_feature_pts
+                        track.feature_cap = flow_track.feature_cap
+                        track.conf = flow_track.conf
+                        track.flow_skip_count = 0
                     else:
                         track.feature_pts = None
+                        track.flow_skip_count = 0
 
                     # check for out of frame case
                     next_bbox = self._convert_state_to_bbox(next_state)
-                    inside_bbox = next_bbox & Rect(cv_rect=(0, 0, self.size[0], self.size[1]))
-                    if inside_bbox is not None:
+                    exit_reason = self._get_exit_reason(next_bbox)
+                    if exit_reason is None:
                         track.bbox = next_bbox
-                        self.kalman_filters[track_id].processNoiseCov = self._compute_acc_cov(next_bbox)
+                        if track_id in skip_ids and track.feature_pts is not None:
+                            # move features with the prediction so flow can resume without detecting them again
+                            track.feature_pts = track.feature_pts + np.subtract(next_bbox.center(), prev_bbox.center())
+                        velocity = next_state[4:, 0].copy()
+                        if track.velocity is not None:
+                            track.vel_change = np.linalg.norm(velocity - track.velocity)
+                        track.velocity = velocity
                     else:
-                        print('[Tracker] Target lost (outside frame): %s' % track)
+                        self.events.emit(EventBus.Type.TRACK_LOST, self.frame_idx, track, exit_reason)
                         del self.tracks[track_id]
                         del self.kalman_filters[track_id]
         else:
             # clear tracks when camera motion estimation failed
             self.tracks.clear()
             self.kalman_filters.clear()
+        self._build_index()
+        self.track_time = time.perf_counter() - track_tic
         # print('kalman filter:', time.perf_counter() - tic)
 
-    def init(self, frame, detections):
+    def close(self):
+        self.flow.close()
+
+    def init(self, ctx, detections):
         """
         Initialize the tracker from detections in the first frame
         """
         if self.tracks or self.kalman_filters:
             self.tracks.clear()
             self.kalman_filters.clear()
-        self.prev_frame_gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        self.prev_frame_small = cv2.resize(self.prev_frame_gray, None, fx=self.flow.optflow_scaling[0], fy=self.flow.optflow_scaling[1])
+        ctx.compute('gray', 'small')
+        self.prev_ctx = ctx
+        self.frame_idx = 0
+        self.track_time = 0
+        self.flow_time = 0
+        self.history.clear()
         for det in detections:
+            if self._get_exit_reason(det.bbox) is not None:
+                continue
             self.tracks[self.new_track_id] = Track(det.label, det.bbox, self.new_track_id)
-            print('[Tracker] Track registered: %s' % self.tracks[self.new_track_id])
+            self.events.emit(EventBus.Type.TRACK_BIRTH, self.frame_idx, self.tracks[self.new_track_id])
             self.new_track_id += 1
+        self._build_index()
 
-    def update(self, detections, tile=None, overlap=None, acquire=True):
+    def update(self, detections, tile=None, overlap=None, acquire=True, frame_idx=None):
         """
-        Update tracks using detections
+        Update tracks using detections of frame frame_idx, counted from init. Detections
+        of an earlier frame still in the history are fused as out-of-sequence measurements.
+        """
+        if frame_idx is not None and frame_idx < self.frame_idx:
+            start_idx = frame_idx + 1 - self.frame_idx + len(self.history) - 1
+            if start_idx >= 0:
+                self._update_delayed(detections, tile, overlap, acquire, start_idx, frame_idx)
+                return
+            self.events.emit(EventBus.Type.STALE_DETECTIONS, frame_idx)
+        self._update(detections, tile, overlap, acquire, self.history[-1] if self.history else None, self.frame_idx)
+
+    def _update_delayed(self, detections, tile, overlap, acquire, start_idx, frame_idx):
+        """
+        Roll the tracks back to the end of the detection frame, update them there and
+        replay the stored flow and warp steps of the following frames. history[start_idx]
+        is the first frame after the detection frame.
+        """
+        start_step = self.history[start_idx]
+        prev_step = self.history[start_idx - 1] if start_idx > 0 else None
+        cur_bboxes = {track_id: track.bbox for track_id, track in self.tracks.items()}
+        # tracks registered after the detection frame are left out
+        hidden_tracks = OrderedDict((track_id, track) for track_id, track in self.tracks.items()
+                                    if track_id not in start_step.start_bboxes)
+        for track_id in hidden_tracks:
+            del self.tracks[track_id]
+        hidden_filters = {track_id: self.kalman_filters.pop(track_id) for track_id in list(self.kalman_filters)
+                          if track_id not in start_step.start_states}
+        for track_id, track in self.tracks.items():
+            track.bbox = start_step.start_bboxes[track_id]
+        replay_ids = list(self.kalman_filters)
+        for track_id in replay_ids:
+            state, cov = start_step.start_states[track_id]
+            np.copyto(self.kalman_filters[track_id].statePost, state)
+            np.copyto(self.kalman_filters[track_id].errorCovPost, cov)
+
+        new_track_id = self.new_track_id
+        self._build_index()
+        self._update(detections, tile, overlap, acquire, prev_step, frame_idx)
+        self.kalman_filters.update((track_id, kalman_filter) for track_id, kalman_filter in hidden_filters.items()
+                                   if track_id in self.tracks or track_id in hidden_tracks)
+
+        for i in range(start_idx, len(self.history)):
+            self._replay_step(self.history[i], [track_id for track_id in replay_ids if track_id in self.kalman_filters])
+        for track_id, track in list(self.tracks.items()):
+            if track_id >= new_track_id:
+                # bring new tracks to the current frame with the camera motion since
+                for step in list(self.history)[start_idx:]:
+                    if step.warp:
+                        track.bbox = self._warp_bbox(track.bbox, step.H_camera)
+                track.init_bbox = track.bbox
+                if any(track.label == hidden_track.label and iou(track.bbox, cur_bboxes[hidden_id]) > 0.1
+                       for hidden_id, hidden_track in hidden_tracks.items()):
+                    # already registered from a more recent detection
+                    del self.tracks[track_id]
+            elif track_id not in self.kalman_filters or track_id not in replay_ids:
+                track.bbox = cur_bboxes[track_id]
+        for track_id, track in hidden_tracks.items():
+            self.tracks[track_id] = track
+            track.bbox = cur_bboxes[track_id]
+        self._build_index()
+
+    def _replay_step(self, step, track_ids):
         """
+        Replay the prediction and measurements of a frame from the current filter states
+        """
+        for track_id in track_ids:
+            kalman_filter = self.kalman_filters[track_id]
+            step.start_states[track_id] = (kalman_filter.statePost.copy(), kalman_filter.errorCovPost.copy())
+            track = self.tracks[track_id]
+            step.start_bboxes[track_id] = track.bbox
+            start_meas = self._convert_bbox_to_meas(track.bbox)
+            if step.warp:
+                self._warp_kalman_filter(track_id, step.H_camera)
+            kalman_filter.transitionMatrix = step.transition_mat
+            kalman_filter.processNoiseCov = self._compute_acc_cov(track.bbox, step.acc_cov)
+            next_state = kalman_filter.predict()
+            self._clip_state(track_id)
+            if track_id in step.flow_meas:
+                flow_offset, meas_cov = step.flow_meas[track_id]
+                kalman_filter.measurementNoiseCov = meas_cov
+                next_state = kalman_filter.correct(start_meas + flow_offset)
+                self._clip_state(track_id)
+            for meas, meas_cov in step.det_meas.get(track_id, []):
+                kalman_filter.measurementNoiseCov = meas_cov
+                next_state = kalman_filter.correct(meas)
+                self._clip_state(track_id)
+
+            next_bbox = self._convert_state_to_bbox(next_state)
+            exit_reason = self._get_exit_reason(next_bbox)
+            if exit_reason is None:
+                track.bbox = next_bbox
+                track.velocity = next_state[4:, 0].copy()
+            else:
+                self.events.emit(EventBus.Type.TRACK_LOST, self.frame_idx, track, exit_reason)
+                del self.tracks[track_id]
+                del self.kalman_filters[track_id]
+
+    def _update(self, detections, tile, overlap, acquire, step, frame_idx):
         if tile is not None:
             assert overlap is not None
             # handle single batch size differently
             sx = sy = 1 - overlap
             scaled_tile = tile.scale(sx, sy)
-            excluded_tracks = []
+            tile_track_ids = self.track_index.query_center(scaled_tile) | self.track_index.query_inside(tile)
+            excluded_track_ids = self.track_index.query_overlap(tile) - tile_track_ids
 
         use_maha_cost = True
         tracks, track_ids = [], []
@@ -284,81 +496,82 @@ class KalmanTracker:
                 tracks.append(track)
             else:
                 # filter out tracks and detections not in tile
-                if track.bbox.center() in scaled_tile or tile.contains_rect(track.bbox): 
+                if track_id in tile_track_ids:
                     if track_id not in self.kalman_filters:
                         use_maha_cost = False
                     track_ids.append(track_id)
                     tracks.append(track)
-                elif iou(track.bbox, tile) > 0:
-                    excluded_tracks.append(track)
         self.acquire = acquire
 
         # compute optimal assignment
         all_det_indices = list(range(len(detections)))
         unmatched_det_indices = all_det_indices
         if len(detections) > 0 and len(tracks) > 0:
-            iou_mat = np.array([[iou(track.bbox, det.bbox) for det in detections] for track in tracks], dtype=np.float32)
+            iou_mat = iou_matrix([track.bbox for track in tracks], [det.bbox for det in detections])
+            # validation gating using IOU and same label before the more expensive Chi square test (alpha = 0.05)
+            track_labels = np.array([track.label for track in tracks])
+            det_labels = np.array([det.label for det in detections])
+            feasible = (track_labels[:, None] == det_labels[None, :]) & (iou_mat >= self.min_association_iou)
+            maha_mat = np.zeros((len(tracks), len(detections)), dtype=np.float32)
             if use_maha_cost:
-                maha_mat = np.array([[self._maha_dist(track_id, det) for det in detections] for track_id in track_ids], dtype=np.float32)
-                # max_maha_dist = np.max(maha_mat)
-            else:
-                maha_mat = np.zeros((len(tracks), len(detections)), dtype=np.float32)
-                # max_maha_dist = 1
-            # print('maha', maha_mat)
+                for track_idx, det_idx in zip(*np.nonzero(feasible)):
+                    maha_mat[track_idx, det_idx] = self._maha_dist(track_ids[track_idx], detections[det_idx])
+                feasible &= maha_mat <= self.max_association_maha
             cost = maha_mat + (1 - iou_mat)
-            # validation gating using Chi square test (alpha = 0.05) and IOU, and ensure same label
-            diff_label_mask = np.array([[track.label != det.label for det in detections] for track in tracks])
-            cost[diff_label_mask | (iou_mat < self.min_association_iou) | (maha_mat > self.max_association_maha)] = KalmanTracker.INF_COST
             # print('cost', cost)
 
-            track_indices, det_indices = linear_sum_assignment(cost)
-            unmatched_det_indices = list(set(all_det_indices) - set(det_indices))
+            track_indices, det_indices = sparse_linear_assignment(cost, feasible, KalmanTracker.INF_COST)
+            unmatched_det_indices = sorted(set(all_det_indices) - set(det_indices))
             for track_idx, det_idx in zip(track_indices, det_indices):
                 track_id = track_ids[track_idx]
-                assert(cost[track_idx, det_idx] <= KalmanTracker.INF_COST)
-                if cost[track_idx, det_idx] < KalmanTracker.INF_COST:
-                    if track_id in self.kalman_filters:
-                        self.kalman_filters[track_id].measurementNoiseCov = self._compute_meas_cov(detections[det_idx].bbox, KalmanTracker.Meas.CNN)
-                        det_meas = self._convert_bbox_to_meas(detections[det_idx].bbox)
-                        next_state = self.kalman_filters[track_id].correct(det_meas)
-                        self._clip_state(track_id)
-                        next_bbox = self._convert_state_to_bbox(next_state)
-                        inside_bbox = next_bbox & Rect(cv_rect=(0, 0, self.size[0], self.size[1]))
-                        if inside_bbox is not None:
-                            self.tracks[track_id].bbox = next_bbox
-                            self.tracks[track_id].age = 0
-                            self.kalman_filters[track_id].processNoiseCov = self._compute_acc_cov(next_bbox)
-                        else:
-                            print('[Tracker] Target lost (out of frame): %s' % self.tracks[track_id])
-                            del self.tracks[track_id]
-                            del self.kalman_filters[track_id]
-                    else:
-                        self.tracks[track_id].bbox = detections[det_idx].bbox
+                # a detection far from the prediction sends the track back to flow
+                self.tracks[track_id].detector_agrees = iou_mat[track_idx, det_idx] >= self.min_skip_det_iou
+                self.tracks[track_id].detection_frame_idx = frame_idx
+                if track_id in self.kalman_filters:
+                    meas_cov = self._compute_meas_cov(detections[det_idx].bbox, KalmanTracker.Meas.CNN)
+                    det_meas = self._convert_bbox_to_meas(detections[det_idx].bbox)
+                    if step is not None:
+                        step.det_meas.setdefault(track_id, []).append((det_meas, meas_cov))
+                    self.kalman_filters[track_id].measurementNoiseCov = meas_cov
+                    next_state = self.kalman_filters[track_id].correct(det_meas)
+                    self._clip_state(track_id)
+                    next_bbox = self._convert_state_to_bbox(next_state)
+                    exit_reason = self._get_exit_reason(next_bbox)
+                    if exit_reason is None:
+                        self.tracks[track_id].bbox = next_bbox
                         self.tracks[track_id].age = 0
+                    else:
+                        self.events.emit(EventBus.Type.TRACK_LOST, self.frame_idx, self.tracks[track_id], exit_reason)
+                        del self.tracks[track_id]
+                        del self.kalman_filters[track_id]
                 else:
-                    unmatched_det_indices.append(det_idx)
+                    self.tracks[track_id].bbox = detections[det_idx].bbox
+                    self.tracks[track_id].age = 0
 
         # register new detections
         for det_idx in unmatched_det_indices:
-            if detections[det_idx].conf > self.min_register_conf:
+            if detections[det_idx].conf > self.min_register_conf and self._get_exit_reason(detections[det_idx].bbox) is None:
                 register = True
                 if tile is not None:
-                    for track in excluded_tracks:
+                    for track_id in self.track_index.query_overlap(detections[det_idx].bbox) & excluded_track_ids:
+                        track = self.tracks[track_id]
                         if detections[det_idx].label == track.label and iou(detections[det_idx].bbox, track.bbox) > 0.1:
                             register = False
                 if register:
-                    self.tracks[self.new_track_id] = Track(detections[det_idx].label, detections[det_idx].bbox, self.new_track_id)
-                    print('[Tracker] Track registered: %s' % self.tracks[self.new_track_id])
+                    self.tracks[self.new_track_id] = Track(detections[det_idx].label, detections[det_idx].bbox,
+                                                       self.new_track_id, frame_idx)
+                    self.events.emit(EventBus.Type.TRACK_BIRTH, self.frame_idx, self.tracks[self.new_track_id])
                     self.new_track_id += 1
 
         # clean up lost tracks
         max_age = self.acquisition_max_age if acquire else self.tracking_max_age
         for track_id, track in list(self.tracks.items()):
             if track.age > max_age:
-                print('[Tracker] Target lost (age): %s' % self.tracks[track_id])
+                self.events.emit(EventBus.Type.TRACK_LOST, self.frame_idx, track, EventBus.Reason.AGE)
                 del self.tracks[track_id]
                 if track_id in self.kalman_filters:
                     del self.kalman_filters[track_id]
+        self._build_index()
     
     def get_nearest_track(self, classes=None):
         """
@@ -374,25 +587,80 @@ class KalmanTracker:
         nearest_track_id = max(tracks.items(), key=self._compare_dist)[0]
         return nearest_track_id
 
+    def _should_skip_flow(self, track_id, follow_id, rank):
+        """
+        Stable tracks with low position uncertainty, steady velocity and reliable
+        past flow can be predicted without flow for up to max_flow_skip frames.
+        Under load, tracks beyond the nearest max_flow_tracks skip flow as well.
+        """
+        track = self.tracks[track_id]
+        if (track_id == follow_id or track_id not in self.kalman_filters or track.velocity is None
+                or track.flow_skip_count >= self.max_flow_skip):
+            return False
+        if self.max_flow_tracks is not None and rank >= self.max_flow_tracks:
+            return True
+        if not track.detector_agrees:
+            return False
+        kalman_filter = self.kalman_filters[track_id]
+        scale = max(track.bbox.size)
+        pos_std = np.sqrt(np.mean(np.diag(kalman_filter.errorCovPost)[:4]))
+        # velocity change over the last frame and from detector corrections since
+        vel_change = max(track.vel_change, np.linalg.norm(kalman_filter.statePost[4:, 0] - track.velocity)) * self.frame_dt
+        return (pos_std / scale <= self.max_skip_pos_std_ratio and vel_change / scale <= self.max_skip_vel_change
+                and track.conf >= self.min_skip_flow_conf)
+
+    def _get_exit_reason(self, bbox):
+        """
+        Reason to drop a track at bbox, or None if it is inside the frame and region of interest
+        """
+        if bbox & Rect(cv_rect=(0, 0, self.size[0], self.size[1])) is None:
+            return EventBus.Reason.OUTSIDE_FRAME
+        if self.roi is not None and self.roi.overlap(bbox) < self.min_roi_overlap:
+            return EventBus.Reason.OUTSIDE_ROI
+        return None
+
+    def _build_index(self):
+        self.track_index.build({track_id: track.bbox for track_id, track in self.tracks.items()})
+
     def _compare_dist(self, id_track_pair):
         # estimate distance using bottow right y coord and area
         bin_height = self.size[1] // self.num_vertical_bin
         return (np.ceil(id_track_pair[1].bbox.ymax / bin_height), id_track_pair[1].bbox.area())
 
-    def _create_kalman_filter(self, init_bbox, cur_bbox):
-        kalman_filter = cv2.KalmanFilter(8, 4)
-        # constant velocity model
-        kalman_filter.transitionMatrix = np.array(
-            [[1, 0, 0, 0, self.vel_coupling * self.dt, 0, (1 - self.vel_coupling) * self.dt, 0],
-             [0, 1, 0, 0, 0, self.vel_coupling * self.dt, 0, (1 - self.vel_coupling) * self.dt], 
-             [0, 0, 1, 0, (1 - self.vel_coupling) * self.dt, 0, self.vel_coupling * self.dt, 0], 
-             [0, 0, 0, 1, 0, (1 - self.vel_coupling) * self.dt, 0, self.vel_coupling * self.dt], 
-             [0, 0, 0, 0, 0.5**(self.dt / self.vel_half_life), 0, 0, 0], 
-             [0, 0, 0, 0, 0, 0.5**(self.dt / self.vel_half_life), 0, 0], 
-             [0, 0, 0, 0, 0, 0, 0.5**(self.dt / self.vel_half_life), 0],
-             [0, 0, 0, 0, 0, 0, 0, 0.5**(self.dt / self.vel_half_life)]], 
+    def _get_motion_model(self, dt):
+        # quantize dt so that the cache stays small
+        key = max(int(round(dt / self.dt_resolution)), 1)
+        if key not in self.motion_models:
+            if len(self.motion_models) >= KalmanTracker.MAX_MOTION_MODELS:
+                self.motion_models.clear()
+            dt = key * self.dt_resolution
+            self.motion_models[key] = (dt, self._create_transition_mat(dt), self._create_acc_cov(dt))
+        return self.motion_models[key]
+
+    def _create_transition_mat(self, dt):
+        decay = 0.5**(dt / self.vel_half_life)
+        return np.array(
+            [[1, 0, 0, 0, self.vel_coupling * dt, 0, (1 - self.vel_coupling) * dt, 0],
+             [0, 1, 0, 0, 0, self.vel_coupling * dt, 0, (1 - self.vel_coupling) * dt], 
+             [0, 0, 1, 0, (1 - self.vel_coupling) * dt, 0, self.vel_coupling * dt, 0], 
+             [0, 0, 0, 1, 0, (1 - self.vel_coupling) * dt, 0, self.vel_coupling * dt], 
+             [0, 0, 0, 0, decay, 0, 0, 0], 
+             [0, 0, 0, 0, 0, decay, 0, 0], 
+             [0, 0, 0, 0, 0, 0, decay, 0],
+             [0, 0, 0, 0, 0, 0, 0, decay]], 
             dtype=np.float32
         )
+
+    def _create_acc_cov(self, dt):
+        acc_cov = np.diag(np.array([0.25 * dt**4] * 4 + [dt**2] * 4, dtype=np.float32))
+        acc_cov[4:, :4] = np.eye(4, dtype=np.float32) * (0.5 * dt**3)
+        acc_cov[:4, 4:] = np.eye(4, dtype=np.float32) * (0.5 * dt**3)
+        return acc_cov
+
+    def _create_kalman_filter(self, init_bbox, cur_bbox, elapsed):
+        kalman_filter = cv2.KalmanFilter(8, 4)
+        # constant velocity model
+        kalman_filter.transitionMatrix = self.transition_mat
         
         # kalman_filter.transitionMatrix = np.array(
         #     [[1, 0, 0, 0, self.vel_coupling * self.dt, 0, (1 - self.vel_coupling) * self.dt, 0],
@@ -411,7 +679,7 @@ class KalmanTracker:
         np.copyto(kalman_filter.measurementMatrix, self.meas_mat)
         
         # vels = (np.asarray(cur_bbox.tf_rect()) - np.asarray(init_bbox.tf_rect())) / (self.dt * (self.n_init))
-        center_vel = (np.asarray(cur_bbox.center()) - np.asarray(init_bbox.center())) / (self.dt * self.n_init)
+        center_vel = (np.asarray(cur_bbox.center()) - np.asarray(init_bbox.center())) / elapsed
         kalman_filter.statePre = np.zeros((8, 1), dtype=np.float32)
         kalman_filter.statePre[:4, 0] = cur_bbox.tf_rect()
         # kalman_filter.statePre[4:, 0] = vels
@@ -460,10 +728,10 @@ class KalmanTracker:
         )
         return np.diag(np.square(std / conf)) # TODO: better conf
 
-    def _compute_acc_cov(self, bbox):
+    def _compute_acc_cov(self, bbox, acc_cov=None):
         std_acc_growth_rate = (self.large_size_std_acc[1] - self.small_size_std_acc[1]) / (self.large_size_std_acc[0] - self.small_size_std_acc[0])
         std_acc = self.small_size_std_acc[1] + (max(bbox.size) - self.small_size_std_acc[0]) * std_acc_growth_rate
-        return self.acc_cov * std_acc**2
+        return (self.acc_cov if acc_cov is None else acc_cov) * std_acc**2
 
     def _clip_state(self, track_id):
         kalman_filter = self.kalman_filters[track_id]
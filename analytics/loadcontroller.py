@@ -0,0 +1,101 @@
+from enum import Enum
+from pathlib import Path
+import json
+
+from .events import EventBus
+from .configs import decoder
+
+
+class LoadController:
+    """
+    Keep up with a target frame rate by shedding work in stages. An EMA of the
+    per-frame processing time is compared against the frame budget: above it
+    the next level is applied, well below it the last level is undone. Levels
+    are cumulative and at least hold_frames apart so that each change shows up
+    in the EMA before the next decision. A restore that is followed by another
+    degrade doubles the wait before the next restore to avoid oscillating.
+    """
+    class Level(Enum):
+        FULL = 0
+        REDUCED_FEATURES = 1
+        SKIP_FAR_FLOW = 2
+        SLOW_DETECTOR = 3
+        DROP_FRAMES = 4
+
+    with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
+        config = json.load(config_file, cls=decoder.decoder)['LoadController']
+
+    def __init__(self, analytics, stream=None, target_fps=None):
+        self.analytics = analytics
+        self.stream = stream
+        self.events = EventBus.get()
+        self.target_fps = LoadController.config['target_fps'] if target_fps is None else target_fps
+        self.ema_alpha = LoadController.config['ema_alpha']
+        self.degrade_ratio = LoadController.config['degrade_ratio']
+        self.restore_ratio = LoadController.config['restore_ratio']
+        self.hold_frames = LoadController.config['hold_frames']
+        self.max_restore_hold_frames = LoadController.config['max_restore_hold_frames']
+        self.feature_budget_scale = LoadController.config['feature_budget_scale']
+        self.max_flow_tracks = LoadController.config['max_flow_tracks']
+        self.detector_skip_scale = LoadController.config['detector_skip_scale']
+        self.max_frame_drop = LoadController.config['max_frame_drop']
+        assert self.target_fps > 0
+        assert 0 < self.restore_ratio < self.degrade_ratio
+
+        self.frame_budget = 1 / self.target_fps
+        # frames cannot be dropped without access to the capture queue
+        self.max_level = LoadController.Level.DROP_FRAMES if stream is not None else LoadController.Level.SLOW_DETECTOR
+        self.level = LoadController.Level.FULL
+        self.avg_time = None
+        self.frames_since_change = 0
+        self.restore_hold_frames = self.hold_frames
+        self.last_change_restored = False
+        self.change_count = 0
+
+    def reset(self):
+        self.avg_time = None
+        self.restore_hold_frames = self.hold_frames
+        self.last_change_restored = False
+        self._set_level(LoadController.Level.FULL)
+
+    def update(self, elapsed):
+        """
+        Call once per frame with its processing time in seconds. Returns the current level.
+        """
+        if self.avg_time is None:
+            self.avg_time = elapsed
+        else:
+            self.avg_time += self.ema_alpha * (elapsed - self.avg_time)
+        self.frames_since_change += 1
+        if self.frames_since_change < self.hold_frames:
+            return self.level
+
+        if self.avg_time > self.degrade_ratio * self.frame_budget and self.level.value < self.max_level.value:
+            if self.last_change_restored:
+                self.restore_hold_frames = min(2 * self.restore_hold_frames, self.max_restore_hold_frames)
+            self.last_change_restored = False
+            self._set_level(LoadController.Level(self.level.value + 1))
+            self.events.emit(EventBus.Type.LOAD_DEGRADE, self.analytics.frame_count,
+                             data=(self.level.name, self.avg_time * 1000, self.frame_budget * 1000))
+        elif (self.avg_time < self.restore_ratio * self.frame_budget and self.level != LoadController.Level.FULL
+                and self.frames_since_change >= self.restore_hold_frames):
+            if self.last_change_restored:
+                # the previous restore held up
+                self.restore_hold_frames = self.hold_frames
+            self.last_change_restored = True
+            self._set_level(LoadController.Level(self.level.value - 1))
+            self.events.emit(EventBus.Type.LOAD_RESTORE, self.analytics.frame_count,
+                             data=(self.level.name, self.avg_time * 1000, self.frame_budget * 1000))
+        return self.level
+
+    def _set_level(self, level):
+        if level != self.level:
+            self.change_count += 1
+        self.level = level
+        self.frames_since_change = 0
+        tracker = self.analytics.tracker
+        tracker.flow.max_budget_scale = self.feature_budget_scale if level.value >= LoadController.Level.REDUCED_FEATURES.value else 1.0
+        tracker.max_flow_tracks = self.max_flow_tracks if level.value >= LoadController.Level.SKIP_FAR_FLOW.value else None
+        self.analytics.detector_skip_scale = self.detector_skip_scale if level.value >= LoadController.Level.SLOW_DETECTOR.value else 1
+        if self.stream is not None:
+            self.stream.max_frame_drop = self.max_frame_drop if level.value >= LoadController.Level.DROP_FRAMES.value else 0
@@ -0,0 +1,287 @@
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from pathlib import Path
+from bisect import bisect_left
+import threading
+import time
+import json
+
+from .events import EventBus
+from .configs import decoder
+
+
+class Counter:
+    """
+    Monotonic count. Either incremented by a single writer or read from fn at scrape time.
+    """
+    type_name = 'counter'
+
+    def __init__(self, name, help, labels=None, fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, self.labels, self.value if self.fn is None else self.fn()
+
+
+class Gauge(Counter):
+    """
+    Value that can go up and down, set by a single writer or read from fn at scrape time
+    """
+    type_name = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """
+    Distribution over fixed bucket upper bounds. Observations only increment a
+    bucket so there is nothing to lock with a single writer, the scrape reads
+    a possibly one observation old snapshot.
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name, help, buckets, labels=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        # the last count is above the largest bound
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        counts = list(self.counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            yield self.name + '_bucket', dict(self.labels or {}, le=repr(float(bound))), cumulative
+        cumulative += counts[-1]
+        yield self.name + '_bucket', dict(self.labels or {}, le='+Inf'), cumulative
+        yield self.name + '_sum', self.labels, self.sum
+        yield self.name + '_count', self.labels, cumulative
+
+    def quantile(self, q):
+        """
+        Estimate by linear interpolation within the bucket of the q-th observation
+        """
+        counts = list(self.counts)
+        rank = q * sum(counts)
+        if rank == 0:
+            return None
+        cumulative = 0
+        lower = 0
+        for bound, count in zip(self.buckets, counts):
+            if count > 0 and cumulative + count >= rank:
+                return lower + (bound - lower) * (rank - cumulative) / count
+            cumulative += count
+            lower = bound
+        return self.buckets[-1]
+
+
+class FrameTrace:
+    """
+    Monotonic clock time at which a frame was grabbed and at which it left
+    each stage. The monotonic clock is shared by all processes on the host.
+    """
+    __slots__ = ('frame_idx', 'capture_time', 'stage_times')
+
+    def __init__(self, frame_idx, capture_time):
+        self.frame_idx = frame_idx
+        self.capture_time = capture_time
+        self.stage_times = {}
+
+    def mark(self, stage):
+        """
+        Record the exit of a stage and return the time since capture
+        """
+        now = time.monotonic()
+        self.stage_times[stage] = now
+        return now - self.capture_time
+
+
+class LatencyStats:
+    """
+    Time from capture to the exit of each stage over all traced frames. Each
+    stage is recorded by a single thread.
+    """
+    STAGES = ('read', 'result', 'send', 'output')
+
+    def __init__(self):
+        name = _prefix(Metrics.config['namespace'], 'capture_latency_seconds')
+        buckets = Metrics.config['capture_latency_buckets']
+        self.histograms = {stage: Histogram(name, 'Time from frame capture to the exit of a stage', buckets, {'stage': stage})
+                           for stage in LatencyStats.STAGES}
+
+    def record(self, trace, stage):
+        self.histograms[stage].observe(trace.mark(stage))
+
+    def summary(self):
+        """
+        Frame count, median and 99th percentile in seconds of the recorded stages
+        """
+        return {stage: (sum(histogram.counts), histogram.quantile(0.5), histogram.quantile(0.99))
+                for stage, histogram in self.histograms.items() if any(histogram.counts)}
+
+
+class Metrics:
+    """
+    Opt-in runtime metrics served in the Prometheus text format from a local
+    HTTP thread. The processing loop only increments counters and histogram
+    buckets, everything else is read from the pipeline when scraped.
+    """
+    STAGES = ('capture', 'flow', 'tracker', 'detector', 'output', 'frame')
+
+    with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
+        config = json.load(config_file, cls=decoder.decoder)['Metrics']
+
+    def __init__(self, analytics=None, stream=None, load_controller=None, port=None, latency_stats=None):
+        self.analytics = analytics
+        self.stream = stream
+        self.host = Metrics.config['host']
+        self.port = Metrics.config['port'] if port is None else port
+        self.namespace = Metrics.config['namespace']
+        self.latency_buckets = Metrics.config['latency_buckets']
+
+        self.metrics = []
+        self.frames = self._add(Counter(self._name('frames_total'), 'Frames processed'))
+        self.stage_latency = {
+            stage: self._add(Histogram(self._name('stage_latency_seconds'), 'Processing time per frame by stage',
+                                       self.latency_buckets, {'stage': stage}))
+            for stage in Metrics.STAGES
+        }
+        if stream is not None:
+            self._add(Gauge(self._name('capture_queue_depth'), 'Captured frames waiting to be processed',
+                            fn=lambda: stream.queue_depth))
+            self._add(Counter(self._name('dropped_frames_total'), 'Captured frames dropped before processing',
+                              fn=lambda: stream.dropped_count))
+        if analytics is not None:
+            self._add(Gauge(self._name('active_tracks'), 'Tracks held by the tracker',
+                            fn=lambda: len(analytics.tracker.tracks)))
+            self._add(Gauge(self._name('detector_duty_cycle'), 'Fraction of frames the detector ran on',
+                            fn=lambda: analytics.detector_duty_cycle))
+            self._add(Gauge(self._name('flow_skipped_tracks'), 'Tracks predicted without flow in the last frame',
+                            fn=lambda: analytics.tracker.num_flow_skipped))
+        if latency_stats is not None:
+            for histogram in latency_stats.histograms.values():
+                self._add(histogram)
+        if load_controller is not None:
+            self._add(Gauge(self._name('load_shedding_level'), 'Current load shedding level',
+                            fn=lambda: load_controller.level.value))
+
+        # lifecycle counters are updated on the event bus thread
+        self.events = EventBus.get()
+        self.event_counters = {
+            EventBus.Type.REGISTRATION_FAILED: self._add(Counter(
+                self._name('registration_failures_total'), 'Failed background registrations')),
+            EventBus.Type.TRACK_BIRTH: self._add(Counter(self._name('tracks_created_total'), 'Tracks registered')),
+            EventBus.Type.TRACK_LOST: self._add(Counter(self._name('tracks_lost_total'), 'Tracks lost')),
+        }
+        self._add(Counter(self._name('events_dropped_total'), 'Events dropped by a full event bus',
+                          fn=lambda: self.events.dropped_count))
+        self._add(Counter(self._name('events_suppressed_total'), 'Event log lines suppressed by rate limiting',
+                          fn=lambda: self.events.suppressed_count))
+
+        self.server = None
+        self.server_thread = None
+
+    def start(self):
+        self.events.subscribe(self._count_event, self.event_counters)
+        self.server = HTTPServer((self.host, self.port), self._make_handler())
+        # the bound port when 0 was requested
+        self.port = self.server.server_address[1]
+        self.server_thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.server_thread.start()
+        print('[Metrics] Serving on http://%s:%d/metrics' % (self.host, self.port))
+
+    def stop(self):
+        self.events.unsubscribe(self._count_event)
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server_thread.join()
+            self.server = None
+
+    def observe_frame(self, capture_time, frame_time, analytics_time=None, output_time=0):
+        """
+        Call once per frame with the stage times in seconds. Tracker stages are
+        only recorded for frames that went through analytics.
+        """
+        self.frames.inc()
+        self.stage_latency['capture'].observe(capture_time)
+        self.stage_latency['frame'].observe(frame_time)
+        self.stage_latency['output'].observe(output_time)
+        if analytics_time is not None:
+            tracker = self.analytics.tracker
+            self.stage_latency['flow'].observe(tracker.flow_time)
+            self.stage_latency['tracker'].observe(tracker.track_time - tracker.flow_time)
+            # detector calls and association with the tracks
+            self.stage_latency['detector'].observe(max(analytics_time - tracker.track_time, 0))
+
+    def render(self):
+        """
+        Text exposition of all metrics
+        """
+        lines = []
+        described = set()
+        for metric in self.metrics:
+            if metric.name not in described:
+                described.add(metric.name)
+                lines.append('# HELP %s %s' % (metric.name, metric.help))
+                lines.append('# TYPE %s %s' % (metric.name, metric.type_name))
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_str = ','.join('%s="%s"' % item for item in labels.items())
+                    lines.append('%s{%s} %s' % (name, label_str, _format_value(value)))
+                else:
+                    lines.append('%s %s' % (name, _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def _name(self, name):
+        return _prefix(self.namespace, name)
+
+    def _count_event(self, event):
+        self.event_counters[event.type].inc()
+
+    def _make_handler(self):
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        return Handler
+
+
+def _prefix(namespace, name):
+    return '%s_%s' % (namespace, name) if namespace else name
+
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(int(value))
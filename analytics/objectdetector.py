@@ -1,5 +1,6 @@
 from enum import Enum
 from pathlib import Path
+from collections import deque, namedtuple
 import json
 import pycuda.autoinit
 import pycuda.driver as cuda
@@ -8,7 +9,7 @@ import numpy as np
 import cv2
 import time
 
-from .utils import Rect, iou
+from .utils import Rect, GridIndex, iou, resolution_scale
 from .models import ssd
 from .configs import decoder
 
@@ -33,6 +34,38 @@ class Detection:
         cv2.putText(frame, text, self.bbox.tl(), cv2.FONT_HERSHEY_SIMPLEX, 1, (102, 255, 255), 2, cv2.LINE_AA)
 
 
+# an inference in flight: frame it was submitted for, tile (None for tile batching) and its buffers
+DetectorRequest = namedtuple('DetectorRequest', ['frame_idx', 'tile', 'buffers'])
+
+
+class _InferenceBuffers:
+    """
+    Host and device bindings with their own execution context and CUDA stream
+    """
+    def __init__(self, engine, batch_size):
+        self.host_inputs  = []
+        self.cuda_inputs  = []
+        self.host_outputs = []
+        self.cuda_outputs = []
+        self.bindings = []
+        self.stream = cuda.Stream()
+
+        for binding in engine:
+            size = trt.volume(engine.get_binding_shape(binding)) * batch_size
+            host_mem = cuda.pagelocked_empty(size, np.float32)
+            cuda_mem = cuda.mem_alloc(host_mem.nbytes)
+            self.bindings.append(int(cuda_mem))
+            if engine.binding_is_input(binding):
+                self.host_inputs.append(host_mem)
+                self.cuda_inputs.append(cuda_mem)
+            else:
+                self.host_outputs.append(host_mem)
+                self.cuda_outputs.append(cuda_mem)
+
+        # an execution context must not be shared by concurrent inferences
+        self.context = engine.create_execution_context()
+
+
 class ObjectDetector:
     class Type(Enum):
         TRACKING = 0
@@ -49,32 +82,39 @@ class ObjectDetector:
         trt.init_libnvinfer_plugins(trt_logger, '')
         ObjectDetector.runtime = trt.Runtime(trt_logger)
 
-    def __init__(self, size, classes, detector_type):
+    def __init__(self, size, classes, detector_type, roi=None):
         # initialize parameters
         self.size = size
         self.classes = set(classes)
         self.detector_type = detector_type
+        self.roi = roi
         self.max_det = ObjectDetector.config['max_det']
         self.batch_size = ObjectDetector.config['batch_size']
         self.tile_overlap = ObjectDetector.config['tile_overlap']
         self.merge_iou_thresh = ObjectDetector.config['merge_iou_thresh']
+        self.num_buffers = ObjectDetector.config['num_buffers']
+        assert self.num_buffers >= 1
 
         self.tiles = None
         self.cur_tile = None
         if self.detector_type == ObjectDetector.Type.ACQUISITION:
             self.conf_threshold = ObjectDetector.config['acquisition']['conf_threshold']
             self.tiling_grid = ObjectDetector.config['acquisition']['tiling_grid']
+            self.max_tiles = ObjectDetector.config['acquisition']['max_tiles']
             self.schedule_tiles = ObjectDetector.config['acquisition']['schedule_tiles']
             self.age_to_object_ratio = ObjectDetector.config['acquisition']['age_to_object_ratio']
             self.model = ssd.InceptionV2 #ssd.MobileNetV1
-            self.tile_size = self.model.INPUT_SHAPE[1:][::-1]
+            self._init_tile_size()
+            if self.tiling_grid is None:
+                self.tiling_grid = self._get_tiling_grid()
             self.tiles = self._generate_tiles()
+            self.scaled_tiles = [tile.scale(1 - self.tile_overlap, 1 - self.tile_overlap) for tile in self.tiles]
             self.tile_ages = np.zeros(len(self.tiles))
             self.cur_tile_id = -1
         elif self.detector_type == ObjectDetector.Type.TRACKING:
             self.conf_threshold = ObjectDetector.config['tracking']['conf_threshold']
             self.model = ssd.InceptionV2
-            self.tile_size = self.model.INPUT_SHAPE[1:][::-1]
+            self._init_tile_size()
         # ssd.prepare_model(self.model, trt.DataType.HALF, self.batch_size)
         ssd.prepare_model(self.model, trt.DataType.INT8, self.batch_size)
 
@@ -84,50 +124,37 @@ class ObjectDetector:
             self.engine = ObjectDetector.runtime.deserialize_cuda_engine(buf)
         assert self.max_det <= self.model.TOPK
         assert self.batch_size <= self.engine.max_batch_size
+        assert self.batch_size == 1 or self.tiles is None or len(self.tiles) <= self.batch_size
+        # tile batching only runs as many tiles as cover the region of interest
+        self.num_batch_tiles = len(self.tiles) if self.batch_size > 1 and self.tiles is not None else self.batch_size
 
-        # create buffers
-        self.host_inputs  = []
-        self.cuda_inputs  = []
-        self.host_outputs = []
-        self.cuda_outputs = []
-        self.bindings = []
-        self.stream = cuda.Stream()
-
-        for binding in self.engine:
-            size = trt.volume(self.engine.get_binding_shape(binding)) * self.batch_size
-            host_mem = cuda.pagelocked_empty(size, np.float32)
-            cuda_mem = cuda.mem_alloc(host_mem.nbytes)
-            self.bindings.append(int(cuda_mem))
-            if self.engine.binding_is_input(binding):
-                self.host_inputs.append(host_mem)
-                self.cuda_inputs.append(cuda_mem)
-            else:
-                self.host_outputs.append(host_mem)
-                self.cuda_outputs.append(cuda_mem)
-
-        self.context = self.engine.create_execution_context()
+        # create buffers, preprocessing fills the next set while earlier requests are in flight
+        self.buffers = [_InferenceBuffers(self.engine, self.batch_size) for _ in range(self.num_buffers)]
+        self.buffer_idx = 0
+        self.pending = deque()
+        self.last_request = None
         self.input_batch = np.zeros((self.batch_size, trt.volume(self.model.INPUT_SHAPE)))
     
-    def preprocess(self, frame, tracks={}, track_id=None):
+    def preprocess(self, ctx, tracks={}, track_id=None, track_index=None):
+        assert self.num_pending < self.num_buffers, 'No free detector buffers, collect a result first'
         if self.batch_size > 1:
-            # tile batching
+            # tile batching, overlapping tiles share the normalized frame
             for i, tile in enumerate(self.tiles):
-                frame_tile = tile.crop(frame)
-                frame_tile = cv2.cvtColor(frame_tile, cv2.COLOR_BGR2RGB)
-                frame_tile = frame_tile * (2 / 255) - 1 # Normalize to [-1.0, 1.0] interval (expected by model)
+                if self.tile_size == self.input_size:
+                    frame_tile = tile.crop(ctx.normalized_rgb)
+                else:
+                    frame_tile = self._resize_tile(ctx.crop_rgb(tile)) * (2 / 255) - 1
                 frame_tile = np.transpose(frame_tile, (2, 0, 1)) # HWC -> CHW
                 self.input_batch[i] = frame_tile.ravel()
         else:
             if self.detector_type == ObjectDetector.Type.ACQUISITION:
                 # tile scheduling
                 if self.schedule_tiles:
-                    sx = sy = 1 - self.tile_overlap
+                    if track_index is None:
+                        track_index = GridIndex(self.size, self.tile_size).build({track_id: track.bbox for track_id, track in tracks.items()})
                     tile_num_tracks = np.zeros(len(self.tiles))
-                    for tile_id, tile in enumerate(self.tiles):
-                        scaled_tile = tile.scale(sx, sy)
-                        for track in tracks.values():
-                            if track.bbox.center() in scaled_tile or tile.contains_rect(track.bbox):
-                                tile_num_tracks[tile_id] += 1
+                    for tile_id, (tile, scaled_tile) in enumerate(zip(self.tiles, self.scaled_tiles)):
+                        tile_num_tracks[tile_id] = len(track_index.query_center(scaled_tile) | track_index.query_inside(tile))
                     tile_scores = self.tile_ages * self.age_to_object_ratio + tile_num_tracks
                     self.cur_tile_id = np.argmax(tile_scores)
                     self.tile_ages += 1
@@ -142,29 +169,58 @@ class ObjectDetector:
                 ymin = max(min(self.size[1] - self.tile_size[1], ymin), 0)
                 self.cur_tile = Rect(cv_rect=(xmin, ymin, self.tile_size[0], self.tile_size[1]))
             
-            frame_tile = self.cur_tile.crop(frame)
-            frame_tile = cv2.cvtColor(frame_tile, cv2.COLOR_BGR2RGB)
+            # convert and normalize the tile only instead of the whole frame
+            frame_tile = self._resize_tile(ctx.crop_rgb(self.cur_tile))
             frame_tile = frame_tile * (2 / 255) - 1 # Normalize to [-1.0, 1.0] interval (expected by model)
             frame_tile = np.transpose(frame_tile, (2, 0, 1)) # HWC -> CHW
             self.input_batch[-1] = frame_tile.ravel()
 
-        np.copyto(self.host_inputs[0], self.input_batch.ravel())
+        np.copyto(self.buffers[self.buffer_idx].host_inputs[0], self.input_batch.ravel())
 
-    def infer_async(self):
+    def infer_async(self, frame_idx=None):
+        """
+        Start inference on the preprocessed input, frame_idx is attached to the result
+        """
         # self.tic = time.perf_counter() 
         # inference
-        cuda.memcpy_htod_async(self.cuda_inputs[0], self.host_inputs[0], self.stream)
-        self.context.execute_async(batch_size=self.batch_size, bindings=self.bindings, stream_handle=self.stream.handle)
-        cuda.memcpy_dtoh_async(self.host_outputs[1], self.cuda_outputs[1], self.stream)
-        cuda.memcpy_dtoh_async(self.host_outputs[0], self.cuda_outputs[0], self.stream)
+        buffers = self.buffers[self.buffer_idx]
+        cuda.memcpy_htod_async(buffers.cuda_inputs[0], buffers.host_inputs[0], buffers.stream)
+        buffers.context.execute_async(batch_size=self.num_batch_tiles, bindings=buffers.bindings, stream_handle=buffers.stream.handle)
+        cuda.memcpy_dtoh_async(buffers.host_outputs[1], buffers.cuda_outputs[1], buffers.stream)
+        cuda.memcpy_dtoh_async(buffers.host_outputs[0], buffers.cuda_outputs[0], buffers.stream)
+        self.pending.append(DetectorRequest(frame_idx, self.cur_tile if self.batch_size == 1 else None, buffers))
+        self.buffer_idx = (self.buffer_idx + 1) % self.num_buffers
+
+    @property
+    def num_pending(self):
+        return len(self.pending)
+
+    def is_ready(self):
+        """
+        True if the oldest request has finished and postprocess will not block
+        """
+        return len(self.pending) > 0 and self.pending[0].buffers.stream.is_done()
+
+    def cancel(self):
+        """
+        Wait for and discard all requests in flight
+        """
+        while self.pending:
+            self.pending.popleft().buffers.stream.synchronize()
 
     def postprocess(self):
-        self.stream.synchronize()
+        """
+        Wait for the oldest request and decode its detections. The request,
+        including its frame index and tile, is kept in last_request.
+        """
+        request = self.pending.popleft()
+        request.buffers.stream.synchronize()
+        self.last_request = request
         # print(time.perf_counter() - self.tic)
-        output = self.host_outputs[0]
+        output = request.buffers.host_outputs[0]
         detections = []
-        for tile_idx in range(self.batch_size):
-            tile = self.tiles[tile_idx] if self.batch_size > 1 else self.cur_tile
+        for tile_idx in range(self.num_batch_tiles):
+            tile = self.tiles[tile_idx] if self.batch_size > 1 else request.tile
             tile_offset = tile_idx * self.model.TOPK
             for det_idx in range(self.max_det):
                 offset = (tile_offset + det_idx) * self.model.OUTPUT_LAYOUT
@@ -201,8 +257,8 @@ class ObjectDetector:
         detections = np.append(detections, merged_detections)
         return detections
 
-    def detect_sync(self, frame, tracks={}, track_id=None):
-        self.preprocess(frame, tracks, track_id)
+    def detect_sync(self, ctx, tracks={}, track_id=None, track_index=None):
+        self.preprocess(ctx, tracks, track_id, track_index)
         self.infer_async()
         return self.postprocess()
 
@@ -216,15 +272,54 @@ class ObjectDetector:
         else:
             [cv2.rectangle(frame, tile.tl(), tile.br(), 0, 2) for tile in self.tiles]
 
+    def _init_tile_size(self):
+        # tiles cover the same part of the frame as model inputs at TUNED_HEIGHT
+        # and are resized to the model input at other resolutions
+        self.input_size = self.model.INPUT_SHAPE[1:][::-1]
+        scale = resolution_scale(self.size)
+        self.tile_size = tuple(min(int(round(input_dim * scale)), frame_dim) for input_dim, frame_dim in zip(self.input_size, self.size))
+        self.tile_interpolation = cv2.INTER_AREA if self.tile_size[0] > self.input_size[0] else cv2.INTER_LINEAR
+
+    def _resize_tile(self, frame_tile):
+        if self.tile_size == self.input_size:
+            return frame_tile
+        return cv2.resize(frame_tile, self.input_size, interpolation=self.tile_interpolation)
+
+    def _get_tiling_grid(self):
+        """
+        Grid with the most tiles up to max_tiles that fits in the frame,
+        closest to the frame aspect ratio on ties
+        """
+        max_tiles = self.max_tiles if self.batch_size == 1 else min(self.max_tiles, self.batch_size)
+        max_cols, max_rows = (int((frame_dim - tile_dim) // ((1 - self.tile_overlap) * tile_dim)) + 1
+                              for frame_dim, tile_dim in zip(self.size, self.tile_size))
+        grids = [(cols, rows) for cols in range(1, max_cols + 1) for rows in range(1, max_rows + 1) if cols * rows <= max_tiles]
+        frame_aspect = self.size[0] / self.size[1]
+        return max(grids, key=lambda grid: (grid[0] * grid[1], -abs(np.log(grid[0] * self.tile_size[0] / (grid[1] * self.tile_size[1]) / frame_aspect))))
+
     def _generate_tiles(self):
         width, height = self.size
         tile_width, tile_height = self.tile_size
         step_width = (1 - self.tile_overlap) * tile_width
         step_height = (1 - self.tile_overlap) * tile_height
-        total_width = (self.tiling_grid[0] - 1) * step_width + tile_width
-        total_height = (self.tiling_grid[1] - 1) * step_height + tile_height
-        assert total_width <= width and total_height <= height, "Frame size not large enough for %dx%d tiles" % self.tiling_grid
-        x_offset = width // 2 - total_width // 2
-        y_offset = height // 2 - total_height // 2
-        tiles = [Rect(cv_rect=(int(c * step_width + x_offset), int(r * step_height + y_offset), tile_width, tile_height)) for r in range(self.tiling_grid[1]) for c in range(self.tiling_grid[0])]
+        num_cols, num_rows = self.tiling_grid
+        if self.roi is not None:
+            # only as many tiles as needed to cover the region
+            region_width, region_height = self.roi.rect.size
+            num_cols = min(num_cols, max(int(np.ceil((region_width - tile_width) / step_width)) + 1, 1))
+            num_rows = min(num_rows, max(int(np.ceil((region_height - tile_height) / step_height)) + 1, 1))
+        total_width = (num_cols - 1) * step_width + tile_width
+        total_height = (num_rows - 1) * step_height + tile_height
+        assert total_width <= width and total_height <= height, "Frame size not large enough for %dx%d tiles" % (num_cols, num_rows)
+        if self.roi is None:
+            x_offset = width // 2 - total_width // 2
+            y_offset = height // 2 - total_height // 2
+        else:
+            # center on the region while staying inside the frame
+            center_x, center_y = self.roi.rect.center()
+            x_offset = min(max(center_x - total_width / 2, 0), width - total_width)
+            y_offset = min(max(center_y - total_height / 2, 0), height - total_height)
+        tiles = [Rect(cv_rect=(int(c * step_width + x_offset), int(r * step_height + y_offset), tile_width, tile_height)) for r in range(num_rows) for c in range(num_cols)]
+        if self.roi is not None:
+            tiles = [tile for tile in tiles if self.roi.overlap(tile) > 0]
         return tiles
@@ -0,0 +1,446 @@
+"""
+Process-based layout of the capture, detector and tracker stages.
+
+A capture process decodes frames straight into a ring of frame slots in
+shared memory. The tracker runs in the calling process on zero-copy views
+of those slots and hands detector requests to a detector process, which
+crops tiles from the same slots and sends detections back. A slot is
+written again only after the tracker and every detector request on it have
+released it, so readers never see a frame change underneath them.
+
+Child processes are spawned rather than forked so that each one creates its
+own CUDA context. Stopping sets an event that every blocking wait checks,
+then the children are joined and the shared memory is unlinked by the
+process that created it. Waits in the tracker process also check that the
+child they wait on is alive and raise if it died.
+"""
+
+from pathlib import Path
+from collections import deque, namedtuple
+from multiprocessing import shared_memory
+import multiprocessing
+import queue
+import json
+import numpy as np
+
+from .videoio import VideoIO, I420Frame
+from .framecontext import FrameContext
+from .utils import RegionOfInterest
+from .objectdetector import DetectorRequest
+from .configs import decoder
+
+
+HEADER_DTYPE = np.dtype([
+    ('write_count', '<u8'),
+    ('dropped_count', '<u8'),
+])
+
+SLOT_DTYPE = np.dtype([
+    ('frame_idx', '<i8'),
+    ('timestamp', '<f8'),
+    ('capture_time', '<f8'),
+])
+
+# bounding box of a track, all detector preprocessing needs from the tracker
+TrackBox = namedtuple('TrackBox', ['bbox'])
+
+
+class FrameRing:
+    """
+    Shared memory ring of frame slots with one writer and one reader. Slots
+    are written in order and may be released in any order.
+    """
+    def __init__(self, shape, num_slots, ctx):
+        self.shape = tuple(shape)
+        self.num_slots = num_slots
+        frame_size = int(np.prod(self.shape))
+        size = HEADER_DTYPE.itemsize + num_slots * (SLOT_DTYPE.itemsize + frame_size)
+        self.shm = shared_memory.SharedMemory(create=True, size=size)
+        self.owner = True
+        # one token per free slot and one per written frame not yet read
+        self.free = [ctx.Semaphore(1) for _ in range(num_slots)]
+        self.filled = ctx.Semaphore(0)
+        self.stop_event = ctx.Event()
+        self._map()
+        self.header['write_count'] = 0
+        self.header['dropped_count'] = 0
+        self.read_count = 0
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('header', 'slots', 'frames'):
+            del state[name]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.owner = False
+        self._map()
+
+    def _map(self):
+        buf = self.shm.buf
+        self.header = np.ndarray((), HEADER_DTYPE, buf, 0)
+        self.slots = np.ndarray((self.num_slots,), SLOT_DTYPE, buf, HEADER_DTYPE.itemsize)
+        offset = HEADER_DTYPE.itemsize + self.num_slots * SLOT_DTYPE.itemsize
+        self.frames = np.ndarray((self.num_slots, *self.shape), np.uint8, buf, offset)
+
+    def view(self, seq):
+        """
+        Zero-copy view of the frame written at position seq
+        """
+        return self.frames[seq % self.num_slots]
+
+    def write(self, frame, frame_idx, timestamp, capture_time, timeout=0.1):
+        """
+        Copy a frame into the next slot, waiting for it to be released. Returns
+        False if the ring was stopped first.
+        """
+        seq = int(self.header['write_count'])
+        slot = seq % self.num_slots
+        while not self.free[slot].acquire(timeout=timeout):
+            if self.stop_event.is_set():
+                return False
+        np.copyto(self.frames[slot], frame)
+        self.slots[slot]['frame_idx'] = frame_idx
+        self.slots[slot]['timestamp'] = timestamp
+        self.slots[slot]['capture_time'] = capture_time
+        self.header['write_count'] = seq + 1
+        self.filled.release()
+        return True
+
+    def close_writer(self):
+        # wake up the reader, which finds no new frame
+        self.filled.release()
+
+    def read(self, timeout=0.1, block=True, writer_alive=None):
+        """
+        Position of the next written frame, or None at the end of the stream.
+        Raises if writer_alive reports that the writer died without closing.
+        """
+        while not self.filled.acquire(block, timeout=timeout if block else None):
+            if not block or self.stop_event.is_set():
+                return None
+            if writer_alive is not None and not writer_alive():
+                raise RuntimeError('The frame writer exited without closing the ring')
+        if self.read_count >= int(self.header['write_count']):
+            # woken up by close_writer
+            self.filled.release()
+            return None
+        seq = self.read_count
+        self.read_count += 1
+        return seq
+
+    def release(self, seq):
+        self.free[seq % self.num_slots].release()
+
+    def stop(self):
+        self.stop_event.set()
+
+    def close(self):
+        # keep the final counts readable once the shared memory is gone
+        self.header = self.header.copy()
+        del self.slots, self.frames
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class DetectorClient:
+    """
+    Tracker side of the detector process. Keeps results that arrived ahead of
+    the requests they answer and counts how many users hold each frame slot.
+    """
+    def __init__(self, request_queue, result_queue, release_slot, process, stop_event, timeout=0.1):
+        self.request_queue = request_queue
+        self.result_queue = result_queue
+        self.release_slot = release_slot
+        self.process = process
+        self.stop_event = stop_event
+        self.timeout = timeout
+        self.next_request_id = 0
+        self.results = {}
+        self.holds = {}
+        # ring position of the frame being processed
+        self.seq = None
+
+    def hold(self, seq):
+        self.holds[seq] = self.holds.get(seq, 0) + 1
+
+    def unhold(self, seq):
+        self.holds[seq] -= 1
+        if self.holds[seq] == 0:
+            del self.holds[seq]
+            self.release_slot(seq)
+
+    def submit(self, detector_type, tracks, track_id):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.hold(self.seq)
+        self.request_queue.put((request_id, detector_type, self.seq, tracks, track_id))
+        return request_id
+
+    def poll(self):
+        while True:
+            try:
+                request_id, detections, tile = self.result_queue.get_nowait()
+            except queue.Empty:
+                return
+            self.results[request_id] = (detections, tile)
+
+    def wait(self, request_id):
+        """
+        Block until the result of a request arrives. Requests in flight when
+        the pipeline stops have no detections.
+        """
+        while request_id not in self.results:
+            try:
+                request_id_, detections, tile = self.result_queue.get(timeout=self.timeout)
+            except queue.Empty:
+                if self.stop_event.is_set():
+                    return [], None
+                if not self.process.is_alive():
+                    raise RuntimeError('The detector process exited with code %s' % self.process.exitcode)
+                continue
+            self.results[request_id_] = (detections, tile)
+        return self.results.pop(request_id)
+
+
+class RemoteDetector:
+    """
+    Stand-in for ObjectDetector in the tracker process that forwards requests
+    to the detector process, with the interface Analytics uses
+    """
+    def __init__(self, client, detector_type, tiles, tile_overlap, num_buffers):
+        self.client = client
+        self.detector_type = detector_type
+        self.tiles = tiles
+        self.tile_overlap = tile_overlap
+        self.num_buffers = num_buffers
+        self.cur_tile = None
+        self.pending = deque()
+        self.last_request = None
+        self._request = None
+
+    @property
+    def num_pending(self):
+        return len(self.pending)
+
+    def preprocess(self, ctx, tracks={}, track_id=None, track_index=None):
+        assert self.num_pending < self.num_buffers, 'No free detector buffers, collect a result first'
+        self._request = ({track_id: TrackBox(track.bbox) for track_id, track in tracks.items()}, track_id)
+
+    def infer_async(self, frame_idx=None):
+        tracks, track_id = self._request
+        request_id = self.client.submit(self.detector_type, tracks, track_id)
+        self.pending.append(DetectorRequest(frame_idx, None, (request_id, self.client.seq)))
+
+    def is_ready(self):
+        self.client.poll()
+        return len(self.pending) > 0 and self.pending[0].buffers[0] in self.client.results
+
+    def postprocess(self):
+        request = self.pending.popleft()
+        request_id, seq = request.buffers
+        detections, tile = self.client.wait(request_id)
+        self.client.unhold(seq)
+        self.cur_tile = tile
+        self.last_request = DetectorRequest(request.frame_idx, tile, request.buffers)
+        return detections
+
+    def cancel(self):
+        # the detector process may still read the slots
+        while self.pending:
+            self.postprocess()
+
+    def detect_sync(self, ctx, tracks={}, track_id=None, track_index=None):
+        self.preprocess(ctx, tracks, track_id, track_index)
+        self.infer_async()
+        return self.postprocess()
+
+
+def _capture_main(ring, info_queue, size, input_path, delay, stride, start_time, end_time):
+    stream = VideoIO(size, input_path, None, delay, stride, start_time, end_time)
+    info_queue.put({
+        'vid_size': stream.vid_size,
+        'fps': stream.fps,
+        'capture_dt': stream.capture_dt,
+        'start_frame': stream.start_frame,
+        'capture_format': stream.capture_format,
+    })
+    stream.start_capture()
+    try:
+        while not ring.stop_event.is_set():
+            frame, timestamp = stream.read()
+            if frame is None:
+                break
+            buf = frame.buf if isinstance(frame, I420Frame) else frame
+            ring.header['dropped_count'] = stream.dropped_count
+            if not ring.write(buf, stream.frame_idx, timestamp, stream.capture_time):
+                break
+    finally:
+        ring.close_writer()
+        stream.stop_capture()
+        stream.release()
+        ring.close()
+
+
+def _detector_main(ring, request_queue, result_queue, size, classes, capture_format, roi):
+    from .objectdetector import ObjectDetector
+    ObjectDetector.init_backend()
+    roi = None if roi is None else RegionOfInterest(size, roi)
+    detectors = {detector_type: ObjectDetector(size, classes, detector_type, roi) for detector_type in ObjectDetector.Type}
+    result_queue.put({detector_type: (detector.tiles, detector.tile_overlap, detector.num_buffers)
+                      for detector_type, detector in detectors.items()})
+    # images are only cropped and normalized here, flow scaling is not needed
+    ctx = FrameContext(None, None, roi)
+
+    def collect(detector):
+        detections = detector.postprocess()
+        # requests are tagged with their id in place of the frame index
+        result_queue.put((detector.last_request.frame_idx, list(detections), detector.last_request.tile))
+
+    try:
+        while not ring.stop_event.is_set():
+            try:
+                request = request_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if request is None:
+                break
+            request_id, detector_type, seq, tracks, track_id = request
+            detector = detectors[detector_type]
+            if detector.num_pending == detector.num_buffers:
+                collect(detector)
+            frame = ring.view(seq)
+            ctx.reset(I420Frame(frame) if capture_format == VideoIO.Format.I420 else frame)
+            detector.preprocess(ctx, tracks, track_id)
+            detector.infer_async(request_id)
+            if request_queue.empty():
+                # nothing to overlap with, return all results
+                for detector in detectors.values():
+                    while detector.num_pending > 0:
+                        collect(detector)
+    finally:
+        for detector in detectors.values():
+            detector.cancel()
+        ring.close()
+
+
+class ProcessPipeline:
+    """
+    Drop-in replacement for VideoIO that captures and runs the detector in
+    separate processes. Pass detectors to Analytics to offload detection.
+    """
+    with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
+        config = json.load(config_file, cls=decoder.decoder)['ProcessPipeline']
+
+    def __init__(self, size, classes, input_path=None, delay=0, stride=1, start_time=0, end_time=None, roi=None):
+        self.size = size
+        self.input_path = input_path
+        self.output_path = None
+        self.stride = stride
+        self.num_slots = ProcessPipeline.config['num_slots']
+        self.join_timeout = ProcessPipeline.config['join_timeout']
+        self.capture_format = VideoIO.Format[VideoIO.config['capture_format'].upper()]
+        assert self.num_slots >= 3, 'The tracker holds two frames at a time'
+
+        width, height = self.size
+        shape = (height * 3 // 2, width) if self.capture_format == VideoIO.Format.I420 else (height, width, 3)
+        mp_ctx = multiprocessing.get_context('spawn')
+        self.ring = FrameRing(shape, self.num_slots, mp_ctx)
+        info_queue = mp_ctx.Queue()
+        self.request_queue = mp_ctx.Queue()
+        result_queue = mp_ctx.Queue()
+        self.capture_process = mp_ctx.Process(target=_capture_main, name='capture', args=(
+            self.ring, info_queue, size, input_path, delay, stride, start_time, end_time))
+        self.detector_process = mp_ctx.Process(target=_detector_main, name='detector', args=(
+            self.ring, self.request_queue, result_queue, size, classes, self.capture_format, roi))
+        self.capture_process.start()
+        self.detector_process.start()
+
+        print('[Pipeline] Waiting for capture and detector processes...')
+        info = self._get_startup(info_queue, self.capture_process)
+        self.vid_size = info['vid_size']
+        self.fps = info['fps']
+        self.capture_dt = info['capture_dt']
+        self.start_frame = info['start_frame']
+        self.frame_idx = self.start_frame
+        self.capture_time = None
+        self.max_frame_drop = 0
+        self.client = DetectorClient(self.request_queue, result_queue, self._unhold_slot, self.detector_process, self.ring.stop_event)
+        detector_info = self._get_startup(result_queue, self.detector_process)
+        self.detectors = {detector_type: RemoteDetector(self.client, detector_type, *detector_info[detector_type])
+                          for detector_type in detector_info}
+        # ring positions of the frames the tracker may still read
+        self.tracker_seqs = deque()
+
+    @property
+    def dropped_count(self):
+        return int(self.ring.header['dropped_count'])
+
+    @property
+    def queue_depth(self):
+        return int(self.ring.header['write_count']) - self.ring.read_count
+
+    def start_capture(self):
+        pass
+
+    def stop_capture(self):
+        self.ring.stop()
+
+    def read(self):
+        """
+        Return the next frame as a view into shared memory and its timestamp,
+        or (None, None) at the end of the stream. Views stay valid until two
+        more frames have been read.
+        """
+        seq = self.ring.read(writer_alive=self.capture_process.is_alive)
+        if seq is None:
+            return None, None
+        # skip ahead when processing falls behind
+        for _ in range(self.max_frame_drop):
+            next_seq = self.ring.read(block=False)
+            if next_seq is None:
+                break
+            self.ring.release(seq)
+            seq = next_seq
+        self.client.hold(seq)
+        self.tracker_seqs.append(seq)
+        if len(self.tracker_seqs) > 2:
+            # flow only looks back one frame
+            self.client.unhold(self.tracker_seqs.popleft())
+        self.client.seq = seq
+
+        slot = self.ring.slots[seq % self.num_slots]
+        self.frame_idx = int(slot['frame_idx'])
+        self.capture_time = float(slot['capture_time'])
+        frame = self.ring.view(seq)
+        if self.capture_format == VideoIO.Format.I420:
+            frame = I420Frame(frame)
+        return frame, float(slot['timestamp'])
+
+    def release(self):
+        """
+        Stop and join the child processes and free the shared memory
+        """
+        self.ring.stop()
+        self.request_queue.put(None)
+        for process in (self.capture_process, self.detector_process):
+            process.join(self.join_timeout)
+            if process.is_alive():
+                print('[Pipeline] Terminating %s process' % process.name)
+                process.terminate()
+                process.join()
+        self.ring.close()
+
+    def _get_startup(self, startup_queue, process):
+        while True:
+            try:
+                return startup_queue.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    self.release()
+                    raise RuntimeError('The %s process exited during startup' % process.name)
+
+    def _unhold_slot(self, seq):
+        self.ring.release(seq)
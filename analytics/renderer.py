@@ -0,0 +1,123 @@
+from enum import Enum
+from pathlib import Path
+from collections import deque
+import threading
+import json
+import cv2
+
+from .videoio import I420Frame
+from .configs import decoder
+
+
+class Overlay:
+    """
+    Snapshot of everything drawn on top of a frame so that drawing can
+    happen after the tracker has moved on to the next frame
+    """
+    def __init__(self, tracks, follow_id=None, text=None, detections=(), tiles=(), roi=None):
+        self.tracks = tracks
+        self.follow_id = follow_id
+        self.text = text
+        self.detections = detections
+        self.tiles = tiles
+        self.roi = roi
+
+    def draw(self, frame, debug=False):
+        for track in self.tracks:
+            track.draw(frame, follow=track.track_id == self.follow_id, draw_feature_match=debug)
+        if debug:
+            [det.draw(frame) for det in self.detections]
+            [cv2.rectangle(frame, tile.tl(), tile.br(), 0, 2) for tile in self.tiles]
+            if self.roi is not None:
+                self.roi.draw(frame)
+        if self.text is not None:
+            cv2.putText(frame, self.text, (30, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2, cv2.LINE_AA)
+
+
+class Renderer:
+    """
+    Draw overlays and write output frames on a separate thread
+    """
+    class DropPolicy(Enum):
+        BLOCK = 0
+        DROP_OLDEST = 1
+        DROP_NEWEST = 2
+
+    with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
+        config = json.load(config_file, cls=decoder.decoder)['Renderer']
+
+    def __init__(self, stream=None, debug=False, latency_stats=None):
+        self.stream = stream
+        self.debug = debug
+        self.latency_stats = latency_stats
+        self.max_queue_size = Renderer.config['max_queue_size']
+        self.drop_policy = Renderer.DropPolicy[Renderer.config['drop_policy'].upper()]
+
+        self.frame_queue = deque()
+        self.cond = threading.Condition()
+        self.exit_event = threading.Event()
+        self.render_thread = threading.Thread(target=self._render_frames)
+        self.latest_frame = None
+        self.rendered_count = 0
+        self.dropped_count = 0
+
+    def start(self):
+        if not self.render_thread.is_alive():
+            self.render_thread.start()
+
+    def stop(self):
+        """
+        Render the remaining frames and wait for the thread to exit
+        """
+        with self.cond:
+            self.exit_event.set()
+            self.cond.notify_all()
+        if self.render_thread.is_alive():
+            self.render_thread.join()
+
+    def submit(self, frame, overlay=None, trace=None):
+        """
+        Queue a frame and its overlay without waiting for the encoder
+        unless the drop policy is BLOCK. The FrameTrace of the frame, if any,
+        gets its output stage recorded once the frame is written.
+        """
+        with self.cond:
+            if len(self.frame_queue) >= self.max_queue_size:
+                if self.drop_policy == Renderer.DropPolicy.BLOCK:
+                    while len(self.frame_queue) >= self.max_queue_size and self.render_thread.is_alive():
+                        self.cond.wait()
+                elif self.drop_policy == Renderer.DropPolicy.DROP_OLDEST:
+                    self.frame_queue.popleft()
+                    self.dropped_count += 1
+                else:
+                    self.dropped_count += 1
+                    return
+            self.frame_queue.append((frame, overlay, trace))
+            self.cond.notify_all()
+
+    def get_latest(self):
+        """
+        Most recently rendered frame, used for display on the main thread
+        """
+        return self.latest_frame
+
+    def _render_frames(self):
+        while True:
+            with self.cond:
+                while len(self.frame_queue) == 0 and not self.exit_event.is_set():
+                    self.cond.wait()
+                if len(self.frame_queue) == 0:
+                    break
+                frame, overlay, trace = self.frame_queue.popleft()
+                self.cond.notify_all()
+            if isinstance(frame, I420Frame):
+                # color conversion for display happens here instead of the capture path
+                frame = frame.bgr()
+            if overlay is not None:
+                overlay.draw(frame, self.debug)
+            if self.stream is not None and self.stream.output_path is not None:
+                self.stream.write(frame)
+            self.latest_frame = frame
+            self.rendered_count += 1
+            if trace is not None and self.latency_stats is not None:
+                self.latency_stats.record(trace, 'output')
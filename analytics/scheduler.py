@@ -0,0 +1,85 @@
+from pathlib import Path
+import json
+import numpy as np
+
+from .configs import decoder
+
+
+class DetectorScheduler:
+    """
+    Decide when to run the detector from tracker uncertainty. Each signal is
+    mapped to an urgency in [0, 1] and the largest one interpolates the frame
+    skip between the maximum (calm scene) and the minimum (fast motion).
+    """
+    with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
+        config = json.load(config_file, cls=decoder.decoder)['DetectorScheduler']
+
+    def __init__(self, size):
+        self.size = size
+        self.min_frame_skip = DetectorScheduler.config['min_frame_skip']
+        self.max_frame_skip = DetectorScheduler.config['max_frame_skip']
+        self.max_pos_std_ratio = DetectorScheduler.config['max_pos_std_ratio']
+        self.min_flow_conf = DetectorScheduler.config['min_flow_conf']
+        self.max_camera_motion = DetectorScheduler.config['max_camera_motion']
+        self.max_frames_since_detection = DetectorScheduler.config['max_frames_since_detection']
+        assert 1 <= self.min_frame_skip <= self.max_frame_skip < self.max_frames_since_detection
+
+        self.diagonal = np.hypot(*self.size)
+        self.frames_since_detection = 0
+        self.frame_skip = self.max_frame_skip
+        self.urgency = 0
+        # multiplier on the frame skip set by load shedding
+        self.skip_scale = 1
+
+    def reset(self):
+        self.frames_since_detection = 0
+        self.frame_skip = self.max_frame_skip
+        self.urgency = 0
+
+    def should_detect(self, tracker):
+        """
+        Call once per frame. Returns True if the detector should run on this frame.
+        """
+        self.frames_since_detection += 1
+        self.urgency = max(
+            self._covariance_urgency(tracker),
+            self._flow_urgency(tracker),
+            self._camera_motion_urgency(tracker.H_camera),
+            self._detection_age_urgency(tracker)
+        )
+        self.frame_skip = int(round(self.max_frame_skip - self.urgency * (self.max_frame_skip - self.min_frame_skip))) * self.skip_scale
+        if self.frames_since_detection >= self.frame_skip:
+            self.frames_since_detection = 0
+            return True
+        return False
+
+    def _covariance_urgency(self, tracker):
+        # position uncertainty relative to the box size grows between detections
+        urgency = 0
+        for track_id, kalman_filter in tracker.kalman_filters.items():
+            pos_std = np.sqrt(np.mean(np.diag(kalman_filter.errorCovPost)[:4]))
+            ratio = pos_std / max(tracker.tracks[track_id].bbox.size)
+            urgency = max(urgency, ratio / self.max_pos_std_ratio)
+        return min(urgency, 1)
+
+    def _flow_urgency(self, tracker):
+        if not tracker.tracks:
+            return 0
+        mean_conf = np.mean([track.conf for track in tracker.tracks.values()])
+        return float(np.clip((1 - mean_conf) / (1 - self.min_flow_conf), 0, 1))
+
+    def _detection_age_urgency(self, tracker):
+        # tracks matched at every detector run stay within the maximum skip,
+        # one missed for longer means the detector is needed to confirm it
+        max_age = max((tracker.frame_idx - track.detection_frame_idx for track in tracker.tracks.values()), default=0)
+        urgency = (max_age - self.max_frame_skip) / (self.max_frames_since_detection - self.max_frame_skip)
+        return float(np.clip(urgency, 0, 1))
+
+    def _camera_motion_urgency(self, H_camera):
+        if H_camera is None:
+            return 1
+        # displacement of the frame center relative to the frame diagonal
+        center = np.array([self.size[0] / 2, self.size[1] / 2, 1])
+        warped = H_camera @ center
+        displacement = np.linalg.norm(warped[:2] / warped[2] - center[:2])
+        return min(displacement / (self.max_camera_motion * self.diagonal), 1)
@@ -0,0 +1,201 @@
+"""
+Shared memory ring of per-frame track records for co-located consumers.
+
+The file /dev/shm/<name> holds a header followed by num_slots slots, all
+little-endian with C struct alignment (see HEADER_DTYPE and slot_dtype):
+
+    header: magic, version, num_slots, max_tracks, write_count
+    slot:   seq, frame_idx, timestamp, status, num_tracks, tracks[max_tracks]
+    track:  track_id, label, bbox (xmin, ymin, xmax, ymax), velocity (px/s), conf
+
+Boxes and velocities are in the coordinates given by the writer's scale,
+native video coordinates when written by vision.py.
+
+Record n goes to slot n % num_slots. The writer sets the slot seq to 2n + 1
+before writing and 2n + 2 after, then publishes write_count = n + 1. A reader
+copies a slot and accepts it only if seq was 2n + 2 both before and after
+the copy, so readers never block the writer and retry or skip torn records.
+"""
+
+from collections import namedtuple
+from pathlib import Path
+import mmap
+import time
+import numpy as np
+
+
+MAGIC = 0x4b435254 # 'TRCK'
+VERSION = 1
+
+HEADER_DTYPE = np.dtype([
+    ('magic', '<u4'),
+    ('version', '<u4'),
+    ('num_slots', '<u4'),
+    ('max_tracks', '<u4'),
+    ('write_count', '<u8'),
+], align=True)
+
+TRACK_DTYPE = np.dtype([
+    ('track_id', '<i4'),
+    ('label', '<i4'),
+    ('bbox', '<i4', (4,)),
+    ('velocity', '<f4', (4,)),
+    ('conf', '<f4'),
+], align=True)
+
+FrameRecord = namedtuple('FrameRecord', ['count', 'frame_idx', 'timestamp', 'status', 'tracks'])
+
+
+def slot_dtype(max_tracks):
+    return np.dtype([
+        ('seq', '<u8'),
+        ('frame_idx', '<i8'),
+        ('timestamp', '<f8'),
+        ('status', '<i4'),
+        ('num_tracks', '<i4'),
+        ('tracks', TRACK_DTYPE, (max_tracks,)),
+    ], align=True)
+
+
+def _shm_path(name):
+    return Path('/dev/shm') / name
+
+
+class _Ring:
+    def __init__(self, name, size, create):
+        path = _shm_path(name)
+        flags = 'w+b' if create else 'r+b'
+        with open(path, flags) as shm_file:
+            if create:
+                shm_file.truncate(size)
+            elif size is None:
+                size = path.stat().st_size
+            self.buf = mmap.mmap(shm_file.fileno(), size)
+        self.header = np.ndarray((), HEADER_DTYPE, self.buf, 0)
+
+    def _map_slots(self):
+        self.slot_dtype = slot_dtype(int(self.header['max_tracks']))
+        self.slots = np.ndarray((int(self.header['num_slots']),), self.slot_dtype, self.buf, HEADER_DTYPE.itemsize)
+
+    def close(self):
+        del self.header, self.slots
+        self.buf.close()
+
+
+class TrackWriter(_Ring):
+    """
+    Publish all tracks of every frame to a shared memory ring
+    """
+    def __init__(self, name, num_slots=16, max_tracks=64, scale=(1, 1)):
+        self.name = name
+        # from processing to output coordinates
+        self.scale = np.tile(scale, 2)
+        size = HEADER_DTYPE.itemsize + num_slots * slot_dtype(max_tracks).itemsize
+        super().__init__(name, size, create=True)
+        self.header['magic'] = MAGIC
+        self.header['version'] = VERSION
+        self.header['num_slots'] = num_slots
+        self.header['max_tracks'] = max_tracks
+        self.header['write_count'] = 0
+        self._map_slots()
+        self.write_count = 0
+
+    def write(self, frame_idx, timestamp, status, tracks):
+        """
+        Write a frame record, tracks beyond max_tracks are dropped
+        """
+        count = self.write_count
+        slot = self.slots[count % len(self.slots)]
+        slot['seq'] = 2 * count + 1
+        slot['frame_idx'] = frame_idx
+        slot['timestamp'] = timestamp
+        slot['status'] = status
+        records = slot['tracks']
+        num_tracks = 0
+        for track in tracks:
+            if num_tracks == len(records):
+                break
+            record = records[num_tracks]
+            record['track_id'] = track.track_id
+            record['label'] = track.label
+            record['bbox'] = np.round(np.array(track.bbox.tf_rect()) * self.scale)
+            record['velocity'] = 0 if track.velocity is None else track.velocity * self.scale
+            record['conf'] = track.conf
+            num_tracks += 1
+        slot['num_tracks'] = num_tracks
+        slot['seq'] = 2 * count + 2
+        self.write_count = count + 1
+        self.header['write_count'] = self.write_count
+
+    def unlink(self):
+        self.close()
+        _shm_path(self.name).unlink()
+
+
+class TrackReader(_Ring):
+    """
+    Non-blocking reader for a ring created by TrackWriter
+    """
+    def __init__(self, name, max_retries=3):
+        super().__init__(name, None, create=False)
+        assert self.header['magic'] == MAGIC, 'Not a track export ring'
+        assert self.header['version'] == VERSION, 'Unsupported track export version'
+        self._map_slots()
+        self.max_retries = max_retries
+        self.next_count = 0
+
+    @property
+    def write_count(self):
+        return int(self.header['write_count'])
+
+    def read(self, count):
+        """
+        Copy record count or return None if it is not written yet or was overwritten
+        """
+        slot = self.slots[count % len(self.slots)]
+        seq = 2 * count + 2
+        for _ in range(self.max_retries):
+            if slot['seq'] != seq:
+                if slot['seq'] == seq - 1:
+                    # writer is in the middle of this record
+                    continue
+                return None
+            frame_idx, timestamp, status = int(slot['frame_idx']), float(slot['timestamp']), int(slot['status'])
+            num_tracks = min(int(slot['num_tracks']), len(slot['tracks']))
+            tracks = slot['tracks'][:num_tracks].copy()
+            if slot['seq'] == seq:
+                return FrameRecord(count, frame_idx, timestamp, status, tracks)
+        return None
+
+    def read_latest(self):
+        """
+        Most recent complete record or None
+        """
+        write_count = self.write_count
+        if write_count == 0:
+            return None
+        record = self.read(write_count - 1)
+        if record is not None:
+            self.next_count = write_count
+        return record
+
+    def poll(self):
+        """
+        Records written since the last poll, skipping ones already overwritten
+        """
+        write_count = self.write_count
+        begin = max(self.next_count, write_count - len(self.slots))
+        records = [self.read(count) for count in range(begin, write_count)]
+        self.next_count = write_count
+        return [record for record in records if record is not None]
+
+    def wait(self, timeout=None, interval=0.0001):
+        """
+        Poll until a new record is published
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.write_count <= self.next_count:
+            if deadline is not None and time.monotonic() > deadline:
+                return []
+            time.sleep(interval)
+        return self.poll()
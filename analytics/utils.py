@@ -1,3 +1,6 @@
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 import numpy as np
 import cv2
 
@@ -79,10 +82,206 @@ class Rect:
         return Rect(cv_rect=(xmin, ymin, *size))
 
 
+# frame height that pixel parameters in config.json are tuned for
+TUNED_HEIGHT = 720
+
+
+def resolution_scale(size):
+    """
+    Ratio of the frame height to TUNED_HEIGHT, to scale pixel parameters
+    """
+    return size[1] / TUNED_HEIGHT
+
+
 def iou(rect1, rect2):
     inter_xmin = max(rect1.xmin, rect2.xmin) 
     inter_ymin = max(rect1.ymin, rect2.ymin)
     inter_xmax = min(rect1.xmax, rect2.xmax)
     inter_ymax = min(rect1.ymax, rect2.ymax)
     inter_area = max(0, inter_xmax - inter_xmin + 1) * max(0, inter_ymax - inter_ymin + 1)
-    return inter_area / (rect1.area() + rect2.area() - inter_area)
\ No newline at end of file
+    return inter_area / (rect1.area() + rect2.area() - inter_area)
+
+
+def iou_matrix(rects1, rects2):
+    """
+    Vectorized IoU between two lists of rects
+    """
+    boxes1 = np.array([rect.tf_rect() for rect in rects1], dtype=np.float64).reshape(-1, 4)
+    boxes2 = np.array([rect.tf_rect() for rect in rects2], dtype=np.float64).reshape(-1, 4)
+    inter_wh = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:]) - np.maximum(boxes1[:, None, :2], boxes2[None, :, :2]) + 1
+    inter_area = np.prod(np.clip(inter_wh, 0, None), axis=2)
+    area1 = np.prod(boxes1[:, 2:] - boxes1[:, :2] + 1, axis=1)
+    area2 = np.prod(boxes2[:, 2:] - boxes2[:, :2] + 1, axis=1)
+    return inter_area / (area1[:, None] + area2[None, :] - inter_area)
+
+
+def sparse_linear_assignment(cost, feasible, inf_cost=1e5):
+    """
+    Minimum cost assignment restricted to feasible pairs. The bipartite graph
+    of feasible pairs is split into connected components that are solved
+    independently, which matches a single dense solve with infeasible pairs
+    set to inf_cost. Only feasible matches are returned.
+    """
+    num_rows, num_cols = feasible.shape
+    rows, cols = np.nonzero(feasible)
+    if len(rows) == 0:
+        return np.empty(0, dtype=int), np.empty(0, dtype=int)
+    graph = coo_matrix((np.ones(len(rows)), (rows, num_rows + cols)), shape=(num_rows + num_cols,) * 2)
+    _, labels = connected_components(graph, directed=False)
+    row_labels, col_labels = labels[:num_rows], labels[num_rows:]
+
+    # 1x1 blocks are matched directly
+    num_labels = labels.max() + 1
+    row_counts = np.bincount(row_labels, minlength=num_labels)
+    col_counts = np.bincount(col_labels, minlength=num_labels)
+    trivial = (row_counts[row_labels[rows]] == 1) & (col_counts[row_labels[rows]] == 1)
+    row_indices, col_indices = list(rows[trivial]), list(cols[trivial])
+
+    # group rows and columns of the remaining components
+    row_order = np.argsort(row_labels, kind='stable')
+    col_order = np.argsort(col_labels, kind='stable')
+    components = np.unique(row_labels[rows[~trivial]])
+    row_bounds = np.searchsorted(row_labels[row_order], [components, components + 1])
+    col_bounds = np.searchsorted(col_labels[col_order], [components, components + 1])
+
+    for i in range(len(components)):
+        block_rows = row_order[row_bounds[0, i]:row_bounds[1, i]]
+        block_cols = col_order[col_bounds[0, i]:col_bounds[1, i]]
+        block_cost = cost[np.ix_(block_rows, block_cols)]
+        block_feasible = feasible[np.ix_(block_rows, block_cols)]
+        if len(block_rows) == 1 or len(block_cols) == 1:
+            # a single row or column gets its cheapest feasible match
+            idx = np.argmin(np.where(block_feasible, block_cost, np.inf))
+            row, col = np.unravel_index(idx, block_cost.shape)
+            row_indices.append(block_rows[row])
+            col_indices.append(block_cols[col])
+        else:
+            block_cost = np.where(block_feasible, block_cost, inf_cost)
+            row, col = linear_sum_assignment(block_cost)
+            mask = block_feasible[row, col]
+            row_indices.extend(block_rows[row[mask]])
+            col_indices.extend(block_cols[col[mask]])
+    row_indices, col_indices = np.array(row_indices, dtype=int), np.array(col_indices, dtype=int)
+    order = np.argsort(row_indices)
+    return row_indices[order], col_indices[order]
+
+class GridIndex:
+    """
+    Uniform grid over rectangles for fast region queries. Rebuild it
+    whenever the rectangles change.
+    """
+    def __init__(self, size, cell_size):
+        self.size = size
+        self.cell_size = cell_size
+        self.grid_size = (-(-size[0] // cell_size[0]), -(-size[1] // cell_size[1]))
+        self.rects = {}
+        self.cells = {}
+
+    def __len__(self):
+        return len(self.rects)
+
+    def build(self, rects):
+        """
+        Index a dictionary of key to Rect
+        """
+        self.rects = dict(rects)
+        self.cells = {}
+        for key, rect in self.rects.items():
+            col_begin, row_begin, col_end, row_end = self._cell_range(rect)
+            for row in range(row_begin, row_end + 1):
+                for col in range(col_begin, col_end + 1):
+                    self.cells.setdefault((col, row), []).append(key)
+        return self
+
+    def query_center(self, region):
+        """
+        Keys of rectangles whose center is inside region
+        """
+        return {key for key in self._candidates(region) if self.rects[key].center() in region}
+
+    def query_inside(self, region):
+        """
+        Keys of rectangles fully inside region
+        """
+        return {key for key in self._candidates(region) if region.contains_rect(self.rects[key])}
+
+    def query_overlap(self, region):
+        """
+        Keys of rectangles that intersect region
+        """
+        return {key for key in self._candidates(region) if self.rects[key] & region is not None}
+
+    def _cell_range(self, rect):
+        col_begin = min(max(rect.xmin // self.cell_size[0], 0), self.grid_size[0] - 1)
+        row_begin = min(max(rect.ymin // self.cell_size[1], 0), self.grid_size[1] - 1)
+        col_end = min(max(rect.xmax // self.cell_size[0], 0), self.grid_size[0] - 1)
+        row_end = min(max(rect.ymax // self.cell_size[1], 0), self.grid_size[1] - 1)
+        return int(col_begin), int(row_begin), int(col_end), int(row_end)
+
+    def _candidates(self, region):
+        candidates = set()
+        col_begin, row_begin, col_end, row_end = self._cell_range(region)
+        for row in range(row_begin, row_end + 1):
+            for col in range(col_begin, col_end + 1):
+                candidates.update(self.cells.get((col, row), ()))
+        return candidates
+
+
+class RegionOfInterest:
+    """
+    Part of the frame that is processed, given as a rectangle (xmin, ymin, xmax, ymax)
+    or a polygon of (x, y) points in fractions of the frame width and height, so
+    that it selects the same region at any resolution. The mask and bounding
+    rect are computed once so that each stage can limit its work to the region.
+    """
+    def __init__(self, size, region):
+        self.size = size
+        region = np.asarray(region, dtype=np.float64)
+        if region.ndim == 1:
+            xmin, ymin, xmax, ymax = region
+            region = np.array([(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)])
+        region = region.reshape(-1, 2)
+        assert np.all((region >= 0) & (region <= 1)), 'Region of interest must be in fractions of the frame size'
+        self.polygon = np.int32(np.round(region * (size[0] - 1, size[1] - 1)))
+        self.mask = np.zeros(size[::-1], np.uint8)
+        cv2.fillPoly(self.mask, [self.polygon], 255)
+        ys, xs = np.nonzero(self.mask)
+        assert len(xs) > 0, 'Region of interest is outside the frame'
+        self.rect = Rect(tf_rect=(int(xs.min()), int(ys.min()), int(xs.max()), int(ys.max())))
+        self.area_ratio = len(xs) / (size[0] * size[1])
+        # rectangles need no mask lookups
+        self.is_rect = len(xs) == self.rect.area()
+
+    def overlap(self, rect):
+        """
+        Fraction of the area of rect inside the region
+        """
+        inside = rect & self.rect
+        if inside is None:
+            return 0
+        if self.is_rect:
+            return inside.area() / rect.area()
+        return np.count_nonzero(inside.crop(self.mask)) / rect.area()
+
+    def contains_rect(self, rect):
+        return self.is_rect and self.rect.contains_rect(rect)
+
+    def fill_outside(self, rect, image, value):
+        """
+        Set the pixels of image, the frame cropped to rect, that are outside the region
+        """
+        if not self.contains_rect(rect):
+            image[rect.crop(self.mask) == 0] = value
+
+    def scaled_rect(self, scaling):
+        """
+        Bounding rect in an image resized by scaling
+        """
+        width, height = int(round(self.size[0] * scaling[0])), int(round(self.size[1] * scaling[1]))
+        xmin, ymin = int(self.rect.xmin * scaling[0]), int(self.rect.ymin * scaling[1])
+        xmax = min(int(np.ceil((self.rect.xmax + 1) * scaling[0])), width) - 1
+        ymax = min(int(np.ceil((self.rect.ymax + 1) * scaling[1])), height) - 1
+        return Rect(tf_rect=(xmin, ymin, xmax, ymax))
+
+    def draw(self, frame):
+        cv2.polylines(frame, [self.polygon], True, (255, 255, 255), 1, cv2.LINE_AA)
@@ -1,35 +1,97 @@
+from enum import Enum
 from pathlib import Path
 from collections import deque
 import threading
 import time
 import json
+import numpy as np
 import cv2
 
 from .configs import decoder
 
+
+class I420Frame:
+    """
+    Planar YUV 4:2:0 frame as delivered by the capture pipeline. The luma plane
+    is exposed as a zero-copy grayscale view and BGR is converted on demand.
+    """
+    def __init__(self, buf):
+        self.buf = buf
+        self.size = (buf.shape[1], buf.shape[0] * 2 // 3)
+        self.shape = (self.size[1], self.size[0], 3)
+        self.gray = buf[:self.size[1]]
+        self._bgr = None
+
+    def bgr(self):
+        if self._bgr is None:
+            self._bgr = cv2.cvtColor(self.buf, cv2.COLOR_YUV2BGR_I420)
+        return self._bgr
+
+    def crop_rgb(self, rect):
+        """
+        Convert only the pixels of a tile, widened to even chroma boundaries
+        """
+        width, height = self.size
+        xmin, ymin = rect.xmin & ~1, rect.ymin & ~1
+        xmax, ymax = min(rect.xmax + 2 & ~1, width), min(rect.ymax + 2 & ~1, height)
+        # chroma planes do not start on a row boundary when height / 2 is odd
+        flat = self.buf.ravel()
+        luma_size, chroma_size = width * height, width * height // 4
+        u_plane = flat[luma_size:luma_size + chroma_size].reshape(height // 2, width // 2)
+        v_plane = flat[luma_size + chroma_size:luma_size + 2 * chroma_size].reshape(height // 2, width // 2)
+        chroma = np.s_[ymin // 2:ymax // 2, xmin // 2:xmax // 2]
+        tile = np.concatenate((self.gray[ymin:ymax, xmin:xmax].ravel(), u_plane[chroma].ravel(), v_plane[chroma].ravel()))
+        tile = cv2.cvtColor(tile.reshape(-1, xmax - xmin), cv2.COLOR_YUV2RGB_I420)
+        return tile[rect.ymin - ymin:rect.ymax - ymin + 1, rect.xmin - xmin:rect.xmax - xmin + 1]
+
+
 class VideoIO:
+    class Format(Enum):
+        BGR = 0
+        I420 = 1
+
     with open(Path(__file__).parent / 'configs' / 'config.json') as config_file:
         config = json.load(config_file, cls=decoder.decoder)['VideoIO']
 
-    def __init__(self, size, input_path=None, output_path=None, delay=0):
+    def __init__(self, size, input_path=None, output_path=None, delay=0, stride=1, start_time=0, end_time=None):
         self.size = size
         self.input_path = input_path
         self.output_path = output_path
         self.delay = delay
+        self.stride = stride
+        assert self.stride >= 1, 'Frame stride must be positive'
         self.capture_size = VideoIO.config['capture_size']
         self.camera_fps = VideoIO.config['camera_fps']
         self.flip_method = VideoIO.config['flip_method']
         self.max_queue_size = VideoIO.config['max_queue_size']
+        self.capture_format = VideoIO.Format[VideoIO.config['capture_format'].upper()]
 
         if self.input_path is None:
             # use camera when no input path is provided
             self.cap = cv2.VideoCapture(self._gst_cap_str(), cv2.CAP_GSTREAMER)
+        elif self.capture_format == VideoIO.Format.I420:
+            # decode and scale files to I420 the same way as the camera
+            self.cap = cv2.VideoCapture(self._gst_file_str(), cv2.CAP_GSTREAMER)
         else:
             self.cap = cv2.VideoCapture(self.input_path)
 
         self.fps = self.cap.get(cv2.CAP_PROP_FPS)
-        self.vid_size = (self.cap.get(cv2.CAP_PROP_FRAME_WIDTH), self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-        self.capture_dt = 1 / self.fps
+        if self.input_path is None or self.capture_format == VideoIO.Format.I420:
+            # GStreamer already scales to the processing size
+            self.vid_size = VideoIO.get_native_size(self.input_path)
+        else:
+            self.vid_size = (int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        self.capture_dt = self.stride / self.fps
+        self.start_frame = 0
+        self.end_frame = None
+        if self.input_path is not None:
+            # seek to the start of the time window
+            self.start_frame = int(round(start_time * self.fps))
+            if self.start_frame > 0:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, self.start_frame)
+            if end_time is not None:
+                self.end_frame = int(round(end_time * self.fps))
+                assert self.end_frame > self.start_frame, 'End time must be after start time'
         if self.input_path is None:
             # delay for camera
             self.delay = self.capture_dt = max(self.delay, self.capture_dt)
@@ -43,14 +105,54 @@ class VideoIO:
         ret, frame = self.cap.read()
         if not ret:
             raise RuntimeError("Unable to read video stream")
-        self.frame_queue.append(frame)
+        self.frame_queue.append((frame, self._timestamp(0), 0, time.monotonic()))
+        # number of frames grabbed since the start frame
+        self.grab_count = 1
+        self.dropped_count = 0
+        # index of the last frame returned by read and its monotonic clock time at grab
+        self.frame_idx = self.start_frame
+        self.capture_time = None
+        # older queued frames discarded on each read, set by load shedding
+        self.max_frame_drop = 0
         print('[Video] Stream specs: %dx%d @ %d FPS' % (*self.vid_size, self.fps))
+        if self.vid_size != tuple(self.size):
+            print('[Video] Processing at %dx%d' % tuple(self.size))
+        if self.stride > 1:
+            print('[Video] Processing every %d frames' % self.stride)
         
         if self.output_path is not None:
             assert Path(self.output_path).suffix == '.mp4', 'Only mp4 is supported'
             Path(output_path).parent.mkdir(parents=True, exist_ok=True)
             self.writer = cv2.VideoWriter(self._gst_write_str(), 0, self.fps, self.size, True)
 
+    @staticmethod
+    def get_native_size(input_path=None):
+        """
+        Frame size of a video file, or of the camera after flipping
+        """
+        if input_path is None:
+            width, height = VideoIO.config['capture_size']
+            # rotations and diagonal flips swap width and height
+            return (height, width) if VideoIO.config['flip_method'] % 2 == 1 else (width, height)
+        cap = cv2.VideoCapture(input_path)
+        size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        cap.release()
+        return size
+
+    @staticmethod
+    def get_proc_size(native_size):
+        """
+        Processing size of a stream, scaled down to at most max_proc_height with
+        even dimensions for I420
+        """
+        width, height = native_size
+        scale = min(VideoIO.config['max_proc_height'] / height, 1)
+        return (int(round(width * scale / 2)) * 2, int(round(height * scale / 2)) * 2)
+
+    @property
+    def queue_depth(self):
+        return len(self.frame_queue)
+
     def start_capture(self):
         if not self.cap.isOpened():
             self.cap.open(self._gst_cap_str(), cv2.CAP_GSTREAMER)
@@ -65,18 +167,33 @@ class VideoIO:
         self.capture_thread.join()
 
     def read(self):
+        """
+        Return the next frame and its capture timestamp in seconds, or (None, None)
+        at the end of the stream. Timestamps are media time for files and
+        monotonic clock time for cameras. The monotonic clock time at which the
+        frame was grabbed is kept in capture_time for latency tracing.
+        """
         with self.cond:
             # print('frame queue size:', len(self.frame_queue))
             while len(self.frame_queue) == 0 and not self.exit_event.is_set():
                 self.cond.wait()
             if len(self.frame_queue) == 0 and self.exit_event.is_set():
-                return None
-            frame = self.frame_queue.popleft()
+                return None, None
+            frame, timestamp, grab_index, capture_time = self.frame_queue.popleft()
+            # skip ahead when processing falls behind
+            for _ in range(min(self.max_frame_drop, len(self.frame_queue))):
+                frame, timestamp, grab_index, capture_time = self.frame_queue.popleft()
+                self.dropped_count += 1
             self.cond.notify()
+        self.frame_idx = self.start_frame + grab_index
+        self.capture_time = capture_time
 
-        if self.vid_size != self.size:
+        if self.capture_format == VideoIO.Format.I420:
+            # the pipeline already scales to the processing size
+            return I420Frame(frame), timestamp
+        if frame.shape[1::-1] != self.size:
             frame = cv2.resize(frame, self.size)
-        return frame
+        return frame, timestamp
 
     def write(self, frame):
         assert hasattr(self, 'writer')
@@ -89,6 +206,23 @@ class VideoIO:
             self.writer.release()
 
     def _gst_cap_str(self):
+        if self.capture_format == VideoIO.Format.I420:
+            # skip CPU color conversion and hand the planar buffer to Python
+            return (
+                "nvarguscamerasrc ! "
+                "video/x-raw(memory:NVMM), "
+                "width=(int)%d, height=(int)%d, "
+                "format=(string)NV12, framerate=(fraction)%d/1 ! "
+                "nvvidconv flip-method=%d ! "
+                "video/x-raw, width=(int)%d, height=(int)%d, format=(string)I420 ! "
+                "appsink"
+                % (
+                    *self.capture_size,
+                    self.camera_fps,
+                    self.flip_method,
+                    *self.size
+                )
+            )
         return (
             "nvarguscamerasrc ! "
             "video/x-raw(memory:NVMM), "
@@ -105,24 +239,55 @@ class VideoIO:
             )
     )
 
+    def _gst_file_str(self):
+        return (
+            "filesrc location=%s ! decodebin ! videoconvert ! videoscale ! "
+            "video/x-raw, width=(int)%d, height=(int)%d, format=(string)I420 ! "
+            "appsink"
+            % (self.input_path, *self.size)
+        )
+
     def _gst_write_str(self):
         return 'appsrc ! autovideoconvert ! omxh265enc ! mp4mux ! filesink location = %s ' % self.output_path
 
+    def _timestamp(self, grab_index):
+        if self.input_path is None:
+            return time.monotonic()
+        return (self.start_frame + grab_index) / self.fps
+
     def _capture_frames(self):
-        tic = time.time()
+        tic = time.monotonic()
         while not self.exit_event.is_set():
-            ret, frame = self.cap.read()
-            # ret = self.cap.grab()
+            if self.end_frame is not None and self.start_frame + self.grab_count >= self.end_frame:
+                ret = False
+            else:
+                ret = self.cap.grab()
+                capture_time = time.monotonic()
+                timestamp = self._timestamp(self.grab_count)
+            # only decode and convert frames that are not skipped
+            frame = None
+            grab_index = self.grab_count
+            if ret and self.grab_count % self.stride == 0:
+                time_elapsed = time.monotonic() - tic
+                if self.delay - time_elapsed <= 0.01:
+                    tic = time.monotonic()
+                    ret, frame = self.cap.retrieve()
+            self.grab_count += 1
             with self.cond:
                 if not ret:
                     self.exit_event.set()
                     self.cond.notify()
                     break
-                time_elapsed = time.time() - tic
-                if self.delay - time_elapsed <= 0.01:
-                    # ret, frame = self.cap.retrieve()
-                    tic = time.time()
-                    while len(self.frame_queue) >= self.max_queue_size and not self.exit_event.is_set():
-                        self.cond.wait()
-                    self.frame_queue.append(frame)
+                if frame is not None:
+                    if self.input_path is None:
+                        # shed the oldest camera frame instead of stalling capture, the
+                        # tracker follows the actual time between frames
+                        if len(self.frame_queue) >= self.max_queue_size:
+                            self.frame_queue.popleft()
+                            self.dropped_count += 1
+                    else:
+                        while len(self.frame_queue) >= self.max_queue_size and not self.exit_event.is_set():
+                            self.cond.wait()
+                    self.frame_queue.append((frame, timestamp, grab_index, capture_time))
                     self.cond.notify()
+
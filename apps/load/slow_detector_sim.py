@@ -0,0 +1,106 @@
+import argparse
+import sys
+from collections import deque
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from analytics.loadcontroller import LoadController
+
+
+"""
+Drive the load controller with a synthetic pipeline whose detector slows down
+partway through, in simulated time so that results do not depend on the host
+"""
+
+
+class SyntheticPipeline:
+    def __init__(self, args):
+        self.args = args
+        self.rng = np.random.default_rng(args.seed)
+        flow = SimpleNamespace(max_budget_scale=1.0)
+        tracker = SimpleNamespace(flow=flow, max_flow_tracks=None)
+        self.analytics = SimpleNamespace(tracker=tracker, detector_skip_scale=1)
+        self.stream = SimpleNamespace(max_frame_drop=0)
+        self.frame_count = 0
+
+    def process(self, detector_time):
+        """
+        Processing time of one frame under the current knobs
+        """
+        args = self.args
+        tracker = self.analytics.tracker
+        num_flow_tracks = args.tracks if tracker.max_flow_tracks is None else min(tracker.max_flow_tracks, args.tracks)
+        elapsed = args.base_ms + args.flow_ms * tracker.flow.max_budget_scale
+        elapsed += args.track_flow_ms * num_flow_tracks
+        if self.frame_count % (args.detector_skip * self.analytics.detector_skip_scale) == 0:
+            elapsed += detector_time
+        self.frame_count += 1
+        return elapsed * self.rng.uniform(0.9, 1.1) / 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=900, help='Number of captured frames')
+    parser.add_argument('--capture-fps', type=float, default=30, help='Camera frame rate')
+    parser.add_argument('--target-fps', type=float, help='Processing frame rate to keep up with, defaults to the camera frame rate')
+    parser.add_argument('--tracks', type=int, default=10, help='Number of tracks')
+    parser.add_argument('--base-ms', type=float, default=5, help='Fixed cost per frame')
+    parser.add_argument('--flow-ms', type=float, default=8, help='Feature extraction cost at full budget')
+    parser.add_argument('--track-flow-ms', type=float, default=1.0, help='Flow cost per track')
+    parser.add_argument('--detector-ms', type=float, default=30, help='Detector cost before the slowdown')
+    parser.add_argument('--slow-detector-ms', type=float, default=200, help='Detector cost during the slowdown')
+    parser.add_argument('--slow-range', type=float, nargs=2, default=[0.3, 0.6], help='Slowdown as fractions of the run')
+    parser.add_argument('--detector-skip', type=int, default=5, help='Detector frame skip')
+    parser.add_argument('--queue-size', type=int, default=50, help='Capture queue size')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    args = parser.parse_args()
+
+    pipeline = SyntheticPipeline(args)
+    target_fps = args.capture_fps if args.target_fps is None else args.target_fps
+    controller = LoadController(pipeline.analytics, pipeline.stream, target_fps)
+    capture_dt = 1 / args.capture_fps
+    slow_begin, slow_end = (int(ratio * args.frames) for ratio in args.slow_range)
+
+    # capture index of every frame waiting in the queue
+    queue = deque()
+    next_capture = 0
+    now = 0
+    latencies = []
+    level_frames = {level: 0 for level in LoadController.Level}
+    num_dropped = 0
+    while next_capture < args.frames or queue:
+        # frames captured while the last one was processed
+        while next_capture < args.frames and next_capture * capture_dt <= now:
+            if len(queue) == args.queue_size:
+                queue.popleft()
+                num_dropped += 1
+            queue.append(next_capture)
+            next_capture += 1
+        if not queue:
+            now = next_capture * capture_dt
+            continue
+        capture_idx = queue.popleft()
+        for _ in range(min(pipeline.stream.max_frame_drop, len(queue))):
+            capture_idx = queue.popleft()
+            num_dropped += 1
+
+        slow = slow_begin <= capture_idx < slow_end
+        elapsed = pipeline.process(args.slow_detector_ms if slow else args.detector_ms)
+        now += elapsed
+        latencies.append(now - capture_idx * capture_dt)
+        level_frames[controller.level] += 1
+        controller.update(elapsed)
+
+    latencies = np.array(latencies) * 1000
+    print('processed frames: %d, dropped frames: %d' % (len(latencies), num_dropped))
+    print('latency: mean %.1f ms, p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+        latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max()))
+    print('level changes: %d' % controller.change_count)
+    for level, count in level_frames.items():
+        print('%s: %d frames' % (level.name, count))
+
+
+if __name__ == '__main__':
+    main()
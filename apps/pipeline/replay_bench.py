@@ -0,0 +1,72 @@
+import argparse
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from analytics import VideoIO, Analytics
+from analytics.pipeline import ProcessPipeline
+
+
+"""
+Replay a video file as fast as possible in the single-process and the
+process pipeline layouts and compare throughput per CPU core
+"""
+
+
+def cpu_time():
+    # includes child processes once they have been joined
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def replay(args, use_pipeline):
+    cpu_tic = cpu_time()
+    proc_size = VideoIO.get_proc_size(VideoIO.get_native_size(args.input))
+    if use_pipeline:
+        stream = ProcessPipeline(proc_size, Analytics.config['classes'], args.input, stride=args.stride,
+                                 start_time=args.start, end_time=args.end)
+        analytics = Analytics(proc_size, stream.capture_dt, detectors=stream.detectors)
+    else:
+        stream = VideoIO(proc_size, args.input, stride=args.stride, start_time=args.start, end_time=args.end)
+        analytics = Analytics(proc_size, stream.capture_dt)
+
+    stream.start_capture()
+    tic = time.perf_counter()
+    try:
+        while True:
+            frame, timestamp = stream.read()
+            if frame is None:
+                break
+            analytics.run(frame, timestamp)
+    finally:
+        elapsed = time.perf_counter() - tic
+        analytics.close()
+        if use_pipeline:
+            stream.release()
+        else:
+            stream.stop_capture()
+            stream.release()
+    # model loading is part of the CPU time but excluded from the wall time
+    return analytics.frame_count, elapsed, cpu_time() - cpu_tic
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-i', '--input', required=True, help='Path to input video file')
+    parser.add_argument('--mode', choices=['single', 'pipeline', 'both'], default='both', help='Layouts to benchmark')
+    parser.add_argument('--stride', type=int, default=1, help='Process every n-th input frame')
+    parser.add_argument('--start', type=float, default=0, help='Start time of input video in seconds')
+    parser.add_argument('--end', type=float, help='End time of input video in seconds')
+    args = parser.parse_args()
+
+    modes = ['single', 'pipeline'] if args.mode == 'both' else [args.mode]
+    results = {mode: replay(args, mode == 'pipeline') for mode in modes}
+    print('%-10s %8s %10s %10s %14s' % ('mode', 'frames', 'FPS', 'CPU (s)', 'frames/CPU s'))
+    for mode, (num_frames, elapsed, cpu) in results.items():
+        print('%-10s %8d %10.1f %10.1f %14.1f' % (mode, num_frames, num_frames / elapsed, cpu, num_frames / cpu))
+
+
+if __name__ == '__main__':
+    main()
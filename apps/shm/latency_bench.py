@@ -0,0 +1,75 @@
+import argparse
+import multiprocessing
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
+from analytics.trackexport import TrackWriter, TrackReader
+from analytics.utils import Rect
+
+
+"""
+Measure the delay between publishing a frame record and a reader process seeing it
+"""
+
+
+def reader_loop(name, num_frames, ready, result_queue):
+    reader = TrackReader(name)
+    ready.set()
+    latencies = []
+    num_missed = 0
+    prev_count = -1
+    while len(latencies) + num_missed < num_frames:
+        for record in reader.wait(timeout=1):
+            latencies.append(time.monotonic() - record.timestamp)
+            num_missed += record.count - prev_count - 1
+            prev_count = record.count
+    reader.close()
+    result_queue.put((latencies, num_missed))
+
+
+def make_tracks(num_tracks):
+    return [SimpleNamespace(track_id=i, label=1, bbox=Rect(cv_rect=(10 * i, 10 * i, 50, 100)),
+                            velocity=np.float32([1, 2, 3, 4]), conf=0.9) for i in range(num_tracks)]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--name', default='guardian_tracks_bench', help='Shared memory name')
+    parser.add_argument('--frames', type=int, default=1000, help='Number of frames to publish')
+    parser.add_argument('--tracks', type=int, default=20, help='Tracks per frame')
+    parser.add_argument('--fps', type=float, default=30, help='Publish rate')
+    args = parser.parse_args()
+
+    writer = TrackWriter(args.name)
+    tracks = make_tracks(args.tracks)
+    ready = multiprocessing.Event()
+    result_queue = multiprocessing.Queue()
+    reader = multiprocessing.Process(target=reader_loop, args=(args.name, args.frames, ready, result_queue))
+    reader.start()
+    ready.wait()
+
+    write_times = []
+    for frame_idx in range(args.frames):
+        tic = time.monotonic()
+        writer.write(frame_idx, tic, 0, tracks)
+        write_times.append(time.monotonic() - tic)
+        time.sleep(max(1 / args.fps - (time.monotonic() - tic), 0))
+
+    latencies, num_missed = result_queue.get()
+    reader.join()
+    writer.unlink()
+
+    latencies = np.array(latencies) * 1e6
+    write_times = np.array(write_times) * 1e6
+    print('write: mean %.1f us, p99 %.1f us' % (write_times.mean(), np.percentile(write_times, 99)))
+    print('latency: mean %.1f us, p50 %.1f us, p99 %.1f us, max %.1f us' % (
+        latencies.mean(), np.percentile(latencies, 50), np.percentile(latencies, 99), latencies.max()))
+    print('missed records: %d' % num_missed)
+
+
+if __name__ == '__main__':
+    main()
@@ -17,10 +17,11 @@ class MsgType:
     # return b''.join(int(coord).to_bytes(length, byteorder='big', signed=True) for coord in bbox.tf_rect())
 
 
-def serialize_to_msg(msg_type, bbox=None):
+def serialize_to_msg(msg_type, bbox=None, capture_time=0):
+    capture_time = int(capture_time * TIME_SCALE)
     if bbox is None:
-        return struct.pack('!H8x', msg_type)
-    return struct.pack('!Hhhhh', msg_type, *bbox.tf_rect())
+        return struct.pack('!H8xQ', msg_type, capture_time)
+    return struct.pack('!HhhhhQ', msg_type, *bbox.tf_rect(), capture_time)
 
 
 def parse_from_msg(msg):
@@ -28,6 +29,7 @@ def parse_from_msg(msg):
 
 
 MSG_LENGTH = 2
+TIME_SCALE = 1e6 # microseconds
 sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
 sock.connect('/tmp/guardian_socket')
 sock.setblocking(False)
@@ -60,10 +62,10 @@ for i in range(300):
     #     msg = serialize_to_msg(MsgType.BBOX, analytics.get_target_bbox())
     #     sock.sendall(msg)
     if i == 50:
-        msg = serialize_to_msg(MsgType.TARGET_NOT_FOUND)
+        msg = serialize_to_msg(MsgType.TARGET_NOT_FOUND, capture_time=time.monotonic())
         sock.sendall(msg)
     elif i == 80:
-        msg = serialize_to_msg(MsgType.TARGET_LOST)
+        msg = serialize_to_msg(MsgType.TARGET_LOST, capture_time=time.monotonic())
         sock.sendall(msg)
     
     time.sleep(0.1)
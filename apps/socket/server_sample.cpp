@@ -3,6 +3,8 @@
 #include <netinet/in.h>
 #include <unistd.h>
 #include <stdint.h>
+#include <endian.h>
+#include <time.h>
 #include <cstdlib>
 #include <iostream>
 
@@ -25,11 +27,19 @@ struct BoundingBox {
     int16_t ymax;
 };
 
-struct Message {
+struct __attribute__((packed)) Message {
     uint16_t type;
     BoundingBox bbox;
+    // CLOCK_MONOTONIC time in microseconds at which the frame was captured
+    uint64_t capture_time;
 };
 
+int64_t monotonic_us() {
+    timespec ts;
+    clock_gettime(CLOCK_MONOTONIC, &ts);
+    return (int64_t)ts.tv_sec * 1000000 + ts.tv_nsec / 1000;
+}
+
 int send_signal(int socket, uint16_t *signal) {
     *signal = htons(*signal);
     size_t length = sizeof(uint16_t);
@@ -59,6 +69,7 @@ int recv_msg(int socket, Message *msg) {
     msg->bbox.ymin = ntohs(msg->bbox.ymin);
     msg->bbox.xmax = ntohs(msg->bbox.xmax);
     msg->bbox.ymax = ntohs(msg->bbox.ymax);
+    msg->capture_time = be64toh(msg->capture_time);
     return 0;
 }
 
@@ -118,9 +129,12 @@ int main(int argc, char *argv[]) {
         };
 
         if(msg.type == BBOX) {
-            cout << "server: " << msg.bbox.xmin << " " << msg.bbox.ymin << " " << msg.bbox.xmax << " " << msg.bbox.ymax << endl;
+            int64_t age_us = monotonic_us() - (int64_t)msg.capture_time;
+            cout << "server: " << msg.bbox.xmin << " " << msg.bbox.ymin << " " << msg.bbox.xmax << " " << msg.bbox.ymax
+                 << " (" << age_us / 1000.0 << " ms since capture)" << endl;
             // if target is acquired, this will be sent every frame 
             // TODO: process bbox coordinates and generate control signals to track target.
+            // Extrapolate the target by age_us to compensate for the processing latency.
         }   
         else if(msg.type == TARGET_NOT_FOUND) {
             cout << "server: target not found" << endl;
@@ -9,13 +9,19 @@ import cv2
 
 from analytics import VideoIO
 from analytics import Analytics
+from analytics import Renderer
+from analytics import LoadController
+from analytics import Metrics, LatencyStats, FrameTrace
+from analytics import TrackWriter
+from analytics import ProcessPipeline
 
 
 """
 constants
 """
 MSG_LENGTH = 2
-PROC_SIZE = (1280, 720)
+# the monotonic clock time at which the frame was grabbed ends each outgoing message
+TIME_SCALE = 1e6 # microseconds
 
 
 class MsgType:
@@ -25,10 +31,19 @@ class MsgType:
     BBOX, TARGET_NOT_FOUND, TARGET_LOST, START, STOP, TERMINATE = (i for i in range(6))
 
 
-def serialize_to_msg(msg_type, bbox=None):
+def serialize_to_msg(msg_type, bbox=None, capture_time=0):
+    capture_time = int(capture_time * TIME_SCALE)
     if bbox is None:
-        return struct.pack('!H8x', msg_type)
-    return struct.pack('!Hhhhh', msg_type, *bbox.tf_rect())
+        return struct.pack('!H8xQ', msg_type, capture_time)
+    return struct.pack('!HhhhhQ', msg_type, *(int(round(value)) for value in bbox), capture_time)
+
+
+def to_native(bbox, scale):
+    """
+    Box (xmin, ymin, xmax, ymax) in native video coordinates
+    """
+    xmin, ymin, xmax, ymax = bbox.tf_rect()
+    return (xmin * scale[0], ymin * scale[1], xmax * scale[0], ymax * scale[1])
 
 
 def parse_from_msg(msg):
@@ -43,7 +58,14 @@ def main():
     parser.add_argument('-s', '--socket', action='store_true', help='Turn on socket communication')
     parser.add_argument('--addr', default='/tmp/guardian_socket', help='Socket address')
     parser.add_argument('-l', '--log', action='store_true', help='Output a MOT format tracking log')
+    parser.add_argument('--shm', help='Export all tracks to a shared memory ring with this name')
     parser.add_argument('-g', '--gui', action='store_true', help='Turn on visiualization')
+    parser.add_argument('-p', '--pipeline', action='store_true', help='Run capture and detector in separate processes')
+    parser.add_argument('--metrics-port', type=int, help='Serve Prometheus metrics on this local port')
+    parser.add_argument('--target-fps', type=float, help='Shed work in stages when processing falls below this frame rate')
+    parser.add_argument('--stride', type=int, default=1, help='Process every n-th input frame')
+    parser.add_argument('--start', type=float, default=0, help='Start time of input video in seconds')
+    parser.add_argument('--end', type=float, help='End time of input video in seconds')
     # parser.add_argument('-f', '--flip', type=int, default=0, choices=range(8), help=
     #     "0: none\n"          
     #     "1: counterclockwise\n"
@@ -63,18 +85,39 @@ def main():
             delay = 1 / 30 # main processing loop time
         if args['gui']:
             delay += 0.025 if args['mot'] else 0.055 # gui time
-    stream = VideoIO(PROC_SIZE, args['input'], args['output'], delay)
+    # processing resolution is chosen per stream, results are reported in native coordinates
+    proc_size = VideoIO.get_proc_size(VideoIO.get_native_size(args['input']))
+    if args['pipeline']:
+        assert args['mot'], 'Tracking must be turned on for the process pipeline'
+        assert not args['gui'] and args['output'] is None, 'Rendering is not supported with the process pipeline'
+        stream = ProcessPipeline(proc_size, Analytics.config['classes'], args['input'], delay, args['stride'], args['start'], args['end'],
+                                 Analytics.config['roi'])
+    else:
+        stream = VideoIO(proc_size, args['input'], args['output'], delay, args['stride'], args['start'], args['end'])
+    native_scale = (stream.vid_size[0] / proc_size[0], stream.vid_size[1] / proc_size[1])
 
     sock = None
     mot_log = None
+    track_writer = None
+    renderer = None
+    load_controller = None
+    metrics = None
+    latency_stats = LatencyStats()
     analytics = None
     enable_analytics = False
     elapsed_time = 0    
     gui_time = 0
+    flow_skipped = 0
 
     if args['mot']:
-        analytics = Analytics(PROC_SIZE, stream.capture_dt, args['gui'] or args['output'])
+        analytics = Analytics(proc_size, stream.capture_dt, detectors=stream.detectors if args['pipeline'] else None)
         enable_analytics = True
+    if args['target_fps'] is not None:
+        assert args['mot'], 'Tracking must be turned on for load shedding'
+        load_controller = LoadController(analytics, stream, args['target_fps'])
+    if args['metrics_port'] is not None:
+        metrics = Metrics(analytics, stream, load_controller, args['metrics_port'], latency_stats)
+        metrics.start()
     if args['socket']:
         assert args['mot'], 'Tracking must be turned on for socket transfer'
         sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -85,17 +128,27 @@ def main():
     if args['log']:
         assert args['mot'], 'Tracking must be turned on for logging'
         mot_log = open('mot_log.txt', 'w')
+    if args['shm']:
+        assert args['mot'], 'Tracking must be turned on for track export'
+        track_writer = TrackWriter(args['shm'], scale=native_scale)
     if args['gui']:
         cv2.namedWindow("Video", cv2.WINDOW_AUTOSIZE)
+    if args['gui'] or args['output']:
+        # draw and encode output frames off the processing thread
+        renderer = Renderer(stream, latency_stats=latency_stats)
+        renderer.start()
         
     print('[INFO] Starting video capture...')
     stream.start_capture()
     try:
         while not args['gui'] or cv2.getWindowProperty("Video", 0) >= 0:
             tic = time.perf_counter()
-            frame = stream.read()
+            frame, timestamp = stream.read()
             if frame is None:
                 break
+            trace = FrameTrace(stream.frame_idx, stream.capture_time)
+            latency_stats.record(trace, 'read')
+            proc_tic = time.perf_counter()
             # frame = cv2.medianBlur(frame, 3)
 
             if args['socket']:
@@ -112,6 +165,8 @@ def main():
                             print('client: start')
                             if not enable_analytics:
                                 analytics.reset()
+                                if load_controller is not None:
+                                    load_controller.reset()
                                 elapsed_time = 0
                                 enable_analytics = True
                         elif signal == MsgType.STOP:
@@ -125,55 +180,87 @@ def main():
                             stream.stop_capture()
                             break
 
+            analytics_time = None
             if enable_analytics:
-                analytics.run(frame)
+                analytics.run(frame, timestamp)
+                analytics_time = time.perf_counter() - proc_tic
+                latency_stats.record(trace, 'result')
+                flow_skipped += analytics.tracker.num_flow_skipped
+                frame_idx = stream.frame_idx
+                if track_writer is not None:
+                    track_writer.write(frame_idx, timestamp, analytics.status.value, analytics.tracker.tracks.values())
                 if args['log']:
                     for track_id, track in analytics.tracker.tracks.items():
-                        scaled_xmin = track.bbox.xmin / PROC_SIZE[0] * stream.vid_size[0]
-                        scaled_ymin = track.bbox.ymin / PROC_SIZE[1] * stream.vid_size[1]
-                        scaled_xmax = track.bbox.xmax / PROC_SIZE[0] * stream.vid_size[0]
-                        scaled_ymax = track.bbox.ymax / PROC_SIZE[1] * stream.vid_size[1]
-                        mot_log.write(f'{analytics.frame_count + 1}, {track_id + 1}, {scaled_xmin}, {scaled_ymin}, {scaled_xmax - scaled_xmin + 1}, {scaled_ymax - scaled_ymin + 1}, -1, -1, -1, -1\n')
+                        scaled_xmin, scaled_ymin, scaled_xmax, scaled_ymax = to_native(track.bbox, native_scale)
+                        mot_log.write(f'{frame_idx + 1}, {track_id + 1}, {scaled_xmin}, {scaled_ymin}, {scaled_xmax - scaled_xmin + 1}, {scaled_ymax - scaled_ymin + 1}, -1, -1, -1, -1\n')
                 if args['socket']:
                     if analytics.status == Analytics.Status.TARGET_ACQUIRED:
-                        msg = serialize_to_msg(MsgType.BBOX, analytics.get_target_bbox())
+                        msg = serialize_to_msg(MsgType.BBOX, to_native(analytics.get_target_bbox(), native_scale), trace.capture_time)
                         sock.sendall(msg)
+                        latency_stats.record(trace, 'send')
                     elif analytics.status == Analytics.Status.TARGET_NOT_FOUND:
-                        msg = serialize_to_msg(MsgType.TARGET_NOT_FOUND)
+                        msg = serialize_to_msg(MsgType.TARGET_NOT_FOUND, capture_time=trace.capture_time)
                         sock.sendall(msg)
+                        latency_stats.record(trace, 'send')
                     elif analytics.status == Analytics.Status.TARGET_LOST:
-                        msg = serialize_to_msg(MsgType.TARGET_LOST)
+                        msg = serialize_to_msg(MsgType.TARGET_LOST, capture_time=trace.capture_time)
                         sock.sendall(msg)
+                        latency_stats.record(trace, 'send')
 
-            if args['gui']:
+            if renderer is not None:
                 tic2 = time.perf_counter()
-                # cv2.putText(frame, '%d FPS' % fps, (30, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2, cv2.LINE_AA)
-                cv2.imshow('Video', frame)
-                if cv2.waitKey(1) & 0xFF == 27:
-                    stream.stop_capture()
-                    break
+                renderer.submit(frame, analytics.get_overlay() if enable_analytics else None, trace)
+                if args['gui']:
+                    display_frame = renderer.get_latest()
+                    # cv2.putText(frame, '%d FPS' % fps, (30, 30), cv2.FONT_HERSHEY_SIMPLEX, 1, 0, 2, cv2.LINE_AA)
+                    if display_frame is not None:
+                        cv2.imshow('Video', display_frame)
+                    if cv2.waitKey(1) & 0xFF == 27:
+                        stream.stop_capture()
+                        break
                 toc2 = time.perf_counter()
                 gui_time += toc2 - tic2
-            if args['output'] is not None:
-                stream.write(frame)
             
             toc = time.perf_counter()
             elapsed_time += toc - tic
+            if load_controller is not None and enable_analytics:
+                load_controller.update(toc - proc_tic)
+            if metrics is not None:
+                output_time = toc - proc_tic - (analytics_time or 0)
+                metrics.observe_frame(proc_tic - tic, toc - proc_tic, analytics_time, output_time)
     finally:
         # clean up resources
+        if renderer is not None:
+            renderer.stop()
+        if metrics is not None:
+            metrics.stop()
+        if analytics is not None:
+            analytics.close()
         stream.release()
         if sock is not None:
             sock.close()
         if mot_log is not None:
             mot_log.close()
+        if track_writer is not None:
+            track_writer.unlink()
         cv2.destroyAllWindows()
     
     if not args['socket'] and args['mot']:
         avg_fps = round(analytics.frame_count / elapsed_time)
         print('[INFO] Average FPS: %d' % avg_fps)
+        print('[INFO] Detector duty cycle: %.2f' % analytics.detector_duty_cycle)
+        print('[INFO] Average tracks predicted without flow: %.2f' % (flow_skipped / analytics.frame_count))
         if args['gui']:
             avg_time = gui_time / analytics.frame_count
             print('[INFO] Average GUI time: %f' % avg_time)
+    for stage, (count, median, p99) in latency_stats.summary().items():
+        print('[INFO] Capture to %s latency: median %.1f ms, p99 %.1f ms (%d frames)' % (stage, median * 1000, p99 * 1000, count))
+    if load_controller is not None:
+        print('[INFO] Load shedding level changes: %d, final level: %s' % (load_controller.change_count, load_controller.level.name))
+    if renderer is not None:
+        print('[INFO] Dropped output frames: %d' % renderer.dropped_count)
+    if stream.dropped_count > 0:
+        print('[INFO] Dropped camera frames: %d' % stream.dropped_count)
 
 
 if __name__ == '__main__':